@@ -0,0 +1,124 @@
+#! /usr/bin/env python
+"""
+couchbasekit.breaker
+~~~~~~~~~~~~~~~~~~~~
+
+:website: http://github.com/kirpit/couchbasekit
+:copyright: Copyright 2013, Roy Enjoy <kirpit *at* gmail.com>, see AUTHORS.txt.
+:license: MIT, see LICENSE.txt for details.
+
+Deadlines and circuit breakers around the bucket calls, which are all made
+through :meth:`couchbasekit.connection.Connection.call`.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+@contextmanager
+def deadline(seconds):
+    """Context manager that limits the total time of the couchbase
+    operations within, for the current thread::
+
+        with deadline(0.2):
+            author = Author('kirpit')
+            author.save()
+
+    Nested deadlines can only be shorter than the outer ones, and a
+    deadline of None means no limit.
+
+    :param seconds: Seconds from now.
+    :type seconds: float
+    """
+    outer = getattr(_local, 'deadline', None)
+    if seconds is not None:
+        until = time.time() + seconds
+        _local.deadline = until if outer is None else min(outer, until)
+    try:
+        yield
+    finally:
+        _local.deadline = outer
+
+
+def remaining(timeout=None):
+    """Returns the seconds left for an operation, considering both the
+    current thread's :func:`deadline` and the given timeout.
+
+    :param timeout: Timeout of the operation itself, defaults to None.
+    :type timeout: float
+    :returns: Seconds left (that may be negative), or None if there is no
+        limit at all.
+    :rtype: float
+    """
+    until = getattr(_local, 'deadline', None)
+    left = None if until is None else until - time.time()
+    if timeout is not None and (left is None or timeout < left):
+        return timeout
+    return left
+
+
+class CircuitBreaker(object):
+    """Circuit breaker of a bucket. It is ``'closed'`` as long as the
+    bucket calls work, opens after ``threshold`` consecutive failures (or
+    timeouts) so the calls fail fast with
+    :exc:`couchbasekit.errors.CircuitOpen`, and lets a single probe call go
+    through (``'half_open'``) every ``reset_timeout`` seconds until one of
+    them succeeds.
+
+    Couchbase errors such as "not found" or "key exists" are answers from
+    the server, so they don't count as failures.
+
+    :param threshold: Consecutive failures that open the circuit, defaults
+        to 5.
+    :type threshold: int
+    :param reset_timeout: Seconds to wait before a probe call, defaults
+        to 30.
+    :type reset_timeout: float
+    """
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Tells if a call may go through, which turns an open circuit into
+        half-open once its ``reset_timeout`` has passed.
+
+        :rtype: bool
+        """
+        with self._lock:
+            if self.state=='closed':
+                return True
+            if self.state=='open' and \
+               time.time() - self.opened_at >= self.reset_timeout:
+                # let a single probe through
+                self.state = 'half_open'
+                return True
+            return False
+
+    def succeeded(self):
+        """Records a successful call and closes the circuit.
+
+        :returns: None
+        """
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.opened_at = None
+
+    def failed(self):
+        """Records a failed call, opening the circuit if it was a failed
+        probe or one too many.
+
+        :returns: None
+        """
+        with self._lock:
+            self.failures += 1
+            if self.state=='half_open' or self.failures >= self.threshold:
+                self.state = 'open'
+                self.opened_at = time.time()
@@ -0,0 +1,350 @@
+#! /usr/bin/env python
+"""
+couchbasekit.bulk
+~~~~~~~~~~~~~~~~~
+
+:website: http://github.com/kirpit/couchbasekit
+:copyright: Copyright 2013, Roy Enjoy <kirpit *at* gmail.com>, see AUTHORS.txt.
+:license: MIT, see LICENSE.txt for details.
+
+Bulk export and import of model documents as JSON Lines files and the
+rebalance of sharded models, which can also be used from the command line::
+
+    python -m couchbasekit.bulk export myapp.models.Author all_authors \\
+        --output authors.jsonl.gz --checkpoint authors.checkpoint
+
+    python -m couchbasekit.bulk import myapp.models.Author authors.jsonl.gz \\
+        --workers 8 --rate 2000 --dead-letter rejected.jsonl
+
+    python -m couchbasekit.bulk rebalance myapp.models.Author all_authors \\
+        authors1,authors2 --dry-run
+"""
+import argparse
+import collections
+import gzip
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from couchbasekit import Connection
+from couchbasekit.sharding import rebalance
+
+
+def _open_output(output, compress, append):
+    if output in (None, '-'):
+        return sys.stdout, False
+    mode = 'ab' if append else 'wb'
+    if compress or output.endswith('.gz'):
+        return gzip.open(output, mode), True
+    return open(output, mode), True
+
+
+def _read_checkpoint(checkpoint):
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return None
+    with open(checkpoint, 'r') as f:
+        return json.load(f)
+
+
+def _write_checkpoint(checkpoint, row, bucket_name):
+    # write and rename, not to leave a broken checkpoint behind
+    tmp_file = '%s.tmp' % checkpoint
+    with open(tmp_file, 'w') as f:
+        json.dump({'key': row['key'], 'id': row['id'], 'bucket': bucket_name}, f)
+    os.rename(tmp_file, checkpoint)
+
+
+def _batches(iterable, size):
+    batch = list()
+    for item in iterable:
+        batch.append(item)
+        if len(batch)>=size:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
+
+
+def export(model, view_name, output=None, batch_size=500, compress=False,
+           checkpoint=None, params=None):
+    """Streams all the documents of a model into a JSON Lines file, one
+    document per line, with its couchbase document id as ``_id`` field.
+
+    Document ids are read from a map view of the model (which may also
+    filter the documents) page by page and the documents are fetched with
+    one multi-get per batch, so the memory usage is bounded by
+    ``batch_size``. Documents are written as they are stored, without
+    decoding them into Python values.
+
+    :param model: The model document class to be exported.
+    :type model: :class:`couchbasekit.document.Document` subclass
+    :param view_name: A map view of the model's design document that emits
+        the documents to be exported.
+    :type view_name: str
+    :param output: File path to write into (gzipped if it ends with
+        ``.gz``), defaults to None that is stdout.
+    :type output: str
+    :param batch_size: Number of documents to be fetched at once,
+        defaults to 500.
+    :type batch_size: int
+    :param compress: Gzip the output file regardless of its name, defaults
+        to False.
+    :type compress: bool
+    :param checkpoint: File path to keep the last exported view row, so an
+        interrupted export resumes from there (appending to the output),
+        defaults to None.
+    :type checkpoint: str
+    :param params: Extra view query parameters, defaults to None.
+    :type params: dict
+    :returns: Number of documents exported.
+    :rtype: int
+    """
+    last_row = _read_checkpoint(checkpoint)
+    bucket_names = model._shards()
+    # sharded models are exported bucket by bucket
+    if last_row is not None and last_row.get('bucket') in bucket_names:
+        bucket_names = bucket_names[bucket_names.index(last_row['bucket']):]
+    out, should_close = _open_output(output, compress, last_row is not None)
+    exported = 0
+    try:
+        for bucket_name in bucket_names:
+            bucket_params = dict(params or {})
+            if last_row is not None:
+                bucket_params.update(startkey=last_row['key'],
+                                     startkey_docid=last_row['id'], skip=1)
+                last_row = None
+            rows = model.iter_view(view_name, batch_size=batch_size,
+                                   params=bucket_params, bucket_name=bucket_name)
+            for batch in _batches(rows, batch_size):
+                docs = model.get_multi([row['id'] for row in batch])
+                for row in batch:
+                    doc = docs.get(row['id'])
+                    # deleted in the meantime
+                    if doc is None:
+                        continue
+                    data = dict(doc._raw_data)
+                    data['_id'] = doc.doc_id
+                    out.write(json.dumps(data))
+                    out.write('\n')
+                    exported += 1
+                out.flush()
+                if checkpoint is not None:
+                    _write_checkpoint(checkpoint, batch[-1], bucket_name)
+    finally:
+        if should_close:
+            out.close()
+    return exported
+
+
+def _open_input(source):
+    if source in (None, '-'):
+        return sys.stdin, False
+    if source.endswith('.gz'):
+        return gzip.open(source, 'rb'), True
+    return open(source, 'rb'), True
+
+
+class _RateLimiter(object):
+    # token bucket, refilled by "rate" tokens per second
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.time()
+
+    def wait(self, amount):
+        while True:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now-self.last) * self.rate)
+            self.last = now
+            if self.tokens >= amount or self.tokens >= self.rate:
+                self.tokens -= amount
+                return
+            time.sleep((min(amount, self.rate) - self.tokens) / self.rate)
+
+
+def _new_document(model, doc_id, data):
+    # decoded and migrated like fetched ones, but never trusted
+    loaded = model._from_data(doc_id, None, data)
+    loaded.validate(strict=True)
+    doc = model(dict(
+        (key, loaded._decode_field(key, expose=False)) for key in loaded
+    ))
+    if doc_id is not None and not model.__key_field__:
+        doc._hashed_key = doc_id
+        # over-write the one with the same id, if any
+        doc.is_new_record = False
+    return doc
+
+
+def _import_batch(model, lines):
+    imported = 0
+    rejected = list()
+    for line in lines:
+        try:
+            data = json.loads(line)
+            if not isinstance(data, dict):
+                raise ValueError("Record must be a JSON object.")
+            doc_id = data.pop('_id', None)
+            doc = _new_document(model, doc_id, data)
+            # written directly, bypassing any write-behind buffer
+            doc._store(0, doc._prepare())
+        except Exception as why:
+            rejected.append((line, '%s: %s' % (type(why).__name__, why)))
+        else:
+            imported += 1
+    return imported, rejected
+
+
+def import_documents(model, source=None, workers=None, batch_size=100,
+                     rate=None, max_in_flight=None, dead_letter=None):
+    """Imports documents from a JSON Lines file into couchbase, as exported
+    by :func:`export` or any other JSON objects with the model's field
+    names.
+
+    Records are decoded and validated through the model schema (just like
+    the fetched documents, so old ``doc_version`` ones are migrated too) and
+    saved by a pool of worker processes, in batches, as new documents (so
+    their ``indexes`` and ``aggregates`` are maintained). An optional
+    ``_id`` field is used as the document id for the models without a
+    ``__key_field__``, records with the same id over-write each other.
+
+    The number of batches waiting in the pool is limited by
+    ``max_in_flight`` and batches are only dispatched as fast as ``rate``
+    saves per second allows, not to overload the cluster. Records that
+    can't be parsed, validated or saved are written into the ``dead_letter``
+    file with their error.
+
+    :param model: The model document class to be imported, must be
+        importable by the worker processes.
+    :type model: :class:`couchbasekit.document.Document` subclass
+    :param source: File path to read from (gzipped if it ends with
+        ``.gz``), defaults to None that is stdin.
+    :type source: str
+    :param workers: Number of worker processes, defaults to the number of
+        CPUs.
+    :type workers: int
+    :param batch_size: Number of records per batch, defaults to 100.
+    :type batch_size: int
+    :param rate: Maximum saves per second, defaults to None (unlimited).
+    :type rate: float
+    :param max_in_flight: Maximum number of dispatched but unfinished
+        batches, defaults to twice the number of workers.
+    :type max_in_flight: int
+    :param dead_letter: File path to write the rejected records into as JSON
+        Lines of ``{"record": ..., "error": ...}``, defaults to None.
+    :type dead_letter: str
+    :returns: Dictionary of ``'imported'`` and ``'rejected'`` counts.
+    :rtype: dict
+    :raises: Any error that failed a whole batch before it was run, such as
+        a model that can't be pickled.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    max_in_flight = max_in_flight or workers * 2
+    limiter = _RateLimiter(rate) if rate else None
+    stats = {'imported': 0, 'rejected': 0}
+    dead_file = open(dead_letter, 'ab') if dead_letter is not None else None
+
+    def _collect(pending):
+        # raises if the batch couldn't even be run, i.e. pickling errors
+        imported, rejected = pending.popleft().get()
+        stats['imported'] += imported
+        stats['rejected'] += len(rejected)
+        if dead_file is not None:
+            for line, error in rejected:
+                dead_file.write(json.dumps({'record': line, 'error': error}))
+                dead_file.write('\n')
+
+    pool = multiprocessing.Pool(workers)
+    pending = collections.deque()
+    src, should_close = _open_input(source)
+    try:
+        lines = (line.strip() for line in src)
+        for batch in _batches((line for line in lines if line), batch_size):
+            while len(pending) >= max_in_flight:
+                _collect(pending)
+            if limiter is not None:
+                limiter.wait(len(batch))
+            pending.append(pool.apply_async(_import_batch, (model, batch)))
+        while pending:
+            _collect(pending)
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        if should_close:
+            src.close()
+        if dead_file is not None:
+            dead_file.close()
+    return stats
+
+
+def _get_model(path):
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def main(argv=None):
+    """Command line entry point, see ``python -m couchbasekit.bulk --help``."""
+    parser = argparse.ArgumentParser(prog='python -m couchbasekit.bulk')
+    parser.add_argument('--username', help="couchbase username")
+    parser.add_argument('--password', help="couchbase password")
+    parser.add_argument('--server', default='localhost')
+    parser.add_argument('--port', default='8091')
+    commands = parser.add_subparsers(dest='command')
+
+    export_parser = commands.add_parser(
+        'export', help="export the documents of a model to JSON Lines")
+    export_parser.add_argument('model', help="model path, i.e. myapp.models.Author")
+    export_parser.add_argument('view', help="view name that emits the documents")
+    export_parser.add_argument('-o', '--output', default='-',
+                               help="output file, defaults to stdout")
+    export_parser.add_argument('--batch-size', type=int, default=500)
+    export_parser.add_argument('--gzip', action='store_true')
+    export_parser.add_argument('--checkpoint', help="checkpoint file to resume from")
+
+    import_parser = commands.add_parser(
+        'import', help="import documents of a model from JSON Lines")
+    import_parser.add_argument('model', help="model path, i.e. myapp.models.Author")
+    import_parser.add_argument('input', nargs='?', default='-',
+                               help="input file, defaults to stdin")
+    import_parser.add_argument('--workers', type=int)
+    import_parser.add_argument('--batch-size', type=int, default=100)
+    import_parser.add_argument('--rate', type=float, help="max saves per second")
+    import_parser.add_argument('--max-in-flight', type=int)
+    import_parser.add_argument('--dead-letter', help="file for the rejected records")
+
+    rebalance_parser = commands.add_parser(
+        'rebalance', help="move the documents of a sharded model to their new buckets")
+    rebalance_parser.add_argument('model', help="model path, i.e. myapp.models.Author")
+    rebalance_parser.add_argument('view', help="view name that emits the documents")
+    rebalance_parser.add_argument('old_buckets', help="comma separated old bucket names")
+    rebalance_parser.add_argument('--batch-size', type=int, default=100)
+    rebalance_parser.add_argument('--dry-run', action='store_true')
+
+    args = parser.parse_args(argv)
+    if args.username is not None:
+        Connection.auth(args.username, args.password or '', args.server, args.port)
+    model = _get_model(args.model)
+    if args.command=='export':
+        count = export(model, args.view, args.output, args.batch_size,
+                       args.gzip, args.checkpoint)
+        sys.stderr.write("Exported %d documents.\n" % count)
+    elif args.command=='import':
+        stats = import_documents(model, args.input, args.workers,
+                                 args.batch_size, args.rate,
+                                 args.max_in_flight, args.dead_letter)
+        sys.stderr.write("Imported %(imported)d documents, "
+                         "rejected %(rejected)d.\n" % stats)
+        return 1 if stats['rejected'] else 0
+    elif args.command=='rebalance':
+        count = rebalance(model, tuple(args.old_buckets.split(',')), args.view,
+                          args.batch_size, args.dry_run)
+        sys.stderr.write("%s %d documents.\n"
+                         % ('Would move' if args.dry_run else 'Moved', count))
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+#! /usr/bin/env python
+"""
+couchbasekit.cache
+~~~~~~~~~~~~~~~~~~
+
+:website: http://github.com/kirpit/couchbasekit
+:copyright: Copyright 2013, Roy Enjoy <kirpit *at* gmail.com>, see AUTHORS.txt.
+:license: MIT, see LICENSE.txt for details.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class NegativeCache(object):
+    """Short-living, size bounded in-process cache of the document ids that
+    were recently found missing, so the repeated lookups of the same missing
+    documents (such as slug availability checks) don't make a round-trip to
+    couchbase every time. Assign an instance to your model's
+    ``__negative_cache__`` attribute::
+
+        class Profile(Document):
+            __bucket_name__ = 'mybucket'
+            __negative_cache__ = NegativeCache(ttl=2, max_size=10000)
+            doc_type = 'profile'
+            structure = {
+                # snip snip
+            }
+
+    Saving a document within the same process removes its id from the cache,
+    but documents created by other processes may still look missing for
+    ``ttl`` seconds, so keep it short.
+
+    :param ttl: Seconds that a miss is remembered, defaults to 1.
+    :type ttl: float
+    :param max_size: Maximum number of misses to be remembered, the oldest
+        ones are dropped first, defaults to 10000.
+    :type max_size: int
+    """
+    def __init__(self, ttl=1, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._misses = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._misses)
+
+    def __contains__(self, key):
+        with self._lock:
+            expires_at = self._misses.get(key)
+            if expires_at is None:
+                return False
+            if expires_at <= time.time():
+                del self._misses[key]
+                return False
+            return True
+
+    def add(self, key):
+        """Remembers a missing document.
+
+        :param key: ``(bucket name, document id)`` pair.
+        :type key: tuple
+        :returns: None
+        """
+        with self._lock:
+            # refreshed ones move to the end
+            self._misses.pop(key, None)
+            self._misses[key] = time.time() + self.ttl
+            while len(self._misses) > self.max_size:
+                self._misses.popitem(last=False)
+
+    def discard(self, key):
+        """Forgets a document, i.e. when it is saved.
+
+        :param key: ``(bucket name, document id)`` pair.
+        :type key: tuple
+        :returns: None
+        """
+        with self._lock:
+            self._misses.pop(key, None)
+
+    def clear(self):
+        """Forgets all the misses.
+
+        :returns: None
+        """
+        with self._lock:
+            self._misses.clear()
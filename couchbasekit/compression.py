@@ -0,0 +1,138 @@
+#! /usr/bin/env python
+"""
+couchbasekit.compression
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+:website: http://github.com/kirpit/couchbasekit
+:copyright: Copyright 2013, Roy Enjoy <kirpit *at* gmail.com>, see AUTHORS.txt.
+:license: MIT, see LICENSE.txt for details.
+
+Transparent compression of large documents, which are marked by the
+memcached ``flags`` field of the stored item.
+
+* :class:`couchbasekit.compression.ZlibCodec`
+* :class:`couchbasekit.compression.Bz2Codec`
+"""
+import bz2
+import zlib
+
+# flags bits reserved for the compression codecs
+COMPRESSION_MASK = 0xf0
+
+
+class Codec(object):
+    """The base class of compression codecs. Assign an instance to your
+    model's ``__codec__`` attribute and the documents bigger than its
+    ``threshold`` will be compressed before saving::
+
+        class Book(Document):
+            __bucket_name__ = 'mybucket'
+            __codec__ = ZlibCodec(threshold=10240)
+            doc_type = 'book'
+            structure = {
+                # snip snip
+            }
+
+    Compressed documents are decompressed within
+    :meth:`couchbasekit.document.Document._fetch_data` by looking at their
+    flags, regardless of the model's current codec.
+
+    .. warning::
+       Couchbase stores compressed documents as binary values, so they are
+       NOT indexed by your views anymore. Use it only for the models that are
+       retrieved by their keys.
+
+    :param threshold: Minimum size of the JSON data in bytes to be
+        compressed, defaults to 10240.
+    :type threshold: int
+    """
+    FLAG = None
+
+    def __init__(self, threshold=10240):
+        self.threshold = threshold
+
+    def compress(self, data):
+        raise NotImplementedError()
+
+    def decompress(self, data):
+        raise NotImplementedError()
+
+    def encode(self, json_data):
+        """Compresses the given JSON data if it is big enough.
+
+        :param json_data: Encoded document data.
+        :type json_data: str
+        :returns: ``(flags, data)`` pair to be stored.
+        :rtype: tuple
+        """
+        if len(json_data) < self.threshold:
+            return 0, json_data
+        return self.FLAG, self.compress(json_data)
+
+
+class ZlibCodec(Codec):
+    """Compresses documents with :mod:`zlib`.
+
+    :param threshold: See :class:`Codec`.
+    :type threshold: int
+    :param level: Compression level from 1 to 9, defaults to 6.
+    :type level: int
+    """
+    FLAG = 0x10
+
+    def __init__(self, threshold=10240, level=6):
+        super(ZlibCodec, self).__init__(threshold)
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class Bz2Codec(Codec):
+    """Compresses documents with :mod:`bz2`, which is slower but usually
+    smaller than :class:`ZlibCodec`.
+
+    :param threshold: See :class:`Codec`.
+    :type threshold: int
+    :param level: Compression level from 1 to 9, defaults to 9.
+    :type level: int
+    """
+    FLAG = 0x20
+
+    def __init__(self, threshold=10240, level=9):
+        super(Bz2Codec, self).__init__(threshold)
+        self.level = level
+
+    def compress(self, data):
+        return bz2.compress(data, self.level)
+
+    def decompress(self, data):
+        return bz2.decompress(data)
+
+
+_CODECS = {
+    ZlibCodec.FLAG: ZlibCodec(),
+    Bz2Codec.FLAG: Bz2Codec(),
+}
+
+
+def decompress(flags, data):
+    """Decompresses the stored data if its flags tell so.
+
+    :param flags: Flags of the stored item.
+    :type flags: int
+    :param data: Stored item value.
+    :type data: str
+    :returns: JSON data.
+    :rtype: str
+    :raises: :exc:`ValueError` if flags point to an unknown codec.
+    """
+    flag = (flags or 0) & COMPRESSION_MASK
+    if not flag:
+        return data
+    if flag not in _CODECS:
+        raise ValueError("Unknown compression flag 0x%x." % flag)
+    return _CODECS[flag].decompress(data)
@@ -7,7 +7,21 @@ couchbasekit.connection
 :copyright: Copyright 2013, Roy Enjoy <kirpit *at* gmail.com>, see AUTHORS.txt.
 :license: MIT, see LICENSE.txt for details.
 """
-from couchbase import Couchbase
+import os
+import threading
+from contextlib import contextmanager
+from couchbasekit.breaker import CircuitBreaker, remaining
+from couchbasekit.errors import CircuitOpen, OperationTimeout
+
+
+def _memcached_error():
+    # the driver is imported on the first bucket access, not with couchbasekit
+    from couchbase.exception import MemcachedError
+    return MemcachedError
+
+
+# bucket handles of the threads within Connection.private_buckets()
+_local = threading.local()
 
 
 class Connection(object):
@@ -33,12 +47,22 @@ class Connection(object):
        >>> conn = Connection() # wrong
 
        or you will get a :exc:`RuntimeWarning`.
+
+    Connections are bound to the process that opened them, so a forked
+    process (such as a prefork web server worker) opens its own one instead
+    of sharing the parent's sockets.
     """
     username = None
     password = None
     server = None
     connection = None
     _buckets = {}
+    _spare = {}
+    _spare_lock = threading.Lock()
+    _pid = None
+    breaker_threshold = 5
+    breaker_reset_timeout = 30
+    _breakers = {}
 
     def __new__(cls, *args, **kwargs):
         raise RuntimeWarning('Connection class is not intended to create instances.')
@@ -74,14 +98,73 @@ class Connection(object):
         :rtype: :class:`couchbase.client.Bucket`
         :raises: :exc:`RuntimeError` If the credentials wasn't set.
         """
+        if cls._pid!=os.getpid():
+            cls._forget()
         if cls.connection is None:
             if cls.username is None or cls.password is None:
                 raise RuntimeError("CouchBase credentials are not set to connect.")
+            from couchbase import Couchbase
             cls.connection = Couchbase(cls.server, cls.username, cls.password)
+            cls._pid = os.getpid()
+        private = getattr(_local, 'buckets', None)
+        if private is not None:
+            if bucket_name not in private:
+                private[bucket_name] = cls._borrow(bucket_name)
+            return private[bucket_name][0]
         if bucket_name not in cls._buckets:
             cls._buckets[bucket_name] = cls.connection.bucket(bucket_name)
         return cls._buckets[bucket_name]
 
+    @classmethod
+    @contextmanager
+    def private_buckets(cls):
+        """Context manager that makes the current thread use its own bucket
+        handles within, rather than the ones shared by the application
+        threads. It is meant for the background threads of couchbasekit
+        (and yours), as a bucket handle can't be used by two threads at the
+        same time::
+
+            with Connection.private_buckets():
+                while True:
+                    # snip snip
+
+        The handles are not closed at the end, but kept to be reused by the
+        next private block.
+        """
+        outer = getattr(_local, 'buckets', None)
+        _local.buckets = dict()
+        try:
+            yield
+        finally:
+            buckets, _local.buckets = _local.buckets, outer
+            for bucket, give_back in buckets.itervalues():
+                give_back()
+
+    @classmethod
+    def _borrow(cls, bucket_name):
+        # an idle private handle, or a new one
+        with cls._spare_lock:
+            spare = cls._spare.setdefault(bucket_name, list())
+            bucket = spare.pop() if spare else None
+        if bucket is None:
+            bucket = cls.connection.bucket(bucket_name)
+
+        def give_back():
+            # into the pool it came from, forgotten with the connection
+            with cls._spare_lock:
+                spare.append(bucket)
+        return bucket, give_back
+
+    @classmethod
+    def _discard(cls, bucket_name, bucket):
+        # its socket is busy with an abandoned call
+        if cls._buckets.get(bucket_name) is bucket:
+            cls._buckets.pop(bucket_name, None)
+        private = getattr(_local, 'buckets', None)
+        if private and private.get(bucket_name, (None,))[0] is bucket:
+            # never given back
+            del private[bucket_name]
+
     @classmethod
     def close(cls):
         """Closes the current connection, which would be useful to ensure that
@@ -94,8 +177,156 @@ class Connection(object):
 
         :returns: None
         """
+        # inherited from the parent process, leave them to their owner
+        if cls._pid!=os.getpid():
+            cls._forget()
         if cls.connection is not None:
             try: cls.connection.done()
             except AttributeError: pass
-            cls._buckets = {}
-            cls.connection = None
\ No newline at end of file
+            cls._forget()
+
+    @classmethod
+    def _forget(cls):
+        # drop the handles without closing them
+        cls._buckets = {}
+        cls._spare = {}
+        if getattr(_local, 'buckets', None):
+            _local.buckets = dict()
+        cls.connection = None
+        cls._pid = None
+
+    @classmethod
+    def warmup(cls, buckets):
+        """Opens the given buckets and pings them, so that the first request
+        of a process doesn't pay for the connection setup. Call it at the
+        start of each worker process, such as in gunicorn's ``post_fork``
+        hook::
+
+            def post_fork(server, worker):
+                Connection.warmup(['mybucket', 'sessions'])
+
+        :param buckets: Bucket names to be opened.
+        :type buckets: list
+        :returns: None
+        :raises: :exc:`RuntimeError` If the credentials wasn't set, or
+            :exc:`couchbase.exception.MemcachedError` if a bucket didn't
+            respond properly.
+        """
+        for bucket_name in buckets:
+            bucket = cls.bucket(bucket_name)
+            try:
+                bucket.get('couchbasekit_warmup')
+            except _memcached_error() as why:
+                # raise if other than "not found"
+                if why.status!=1:
+                    raise why
+
+    @classmethod
+    def breaker(cls, bucket_name):
+        """Gives the circuit breaker of a bucket, which is created with the
+        :attr:`breaker_threshold` and :attr:`breaker_reset_timeout` class
+        attributes at its first use.
+
+        :param bucket_name: Bucket name.
+        :type bucket_name: str
+        :rtype: :class:`couchbasekit.breaker.CircuitBreaker`
+        """
+        if bucket_name not in cls._breakers:
+            cls._breakers.setdefault(bucket_name, CircuitBreaker(
+                cls.breaker_threshold, cls.breaker_reset_timeout
+            ))
+        return cls._breakers[bucket_name]
+
+    @classmethod
+    def breaker_states(cls):
+        """Returns the circuit breaker states of the buckets used so far, to
+        be reported by your monitoring, such as
+        ``{'mybucket': 'closed', 'sessions': 'open'}``.
+
+        :rtype: dict
+        """
+        return dict(
+            (bucket_name, breaker.state)
+            for bucket_name, breaker in cls._breakers.items()
+        )
+
+    @classmethod
+    def call(cls, bucket_name, operation, args=(), timeout=None):
+        """Calls a bucket operation through the circuit breaker of the bucket
+        and within the current :func:`couchbasekit.breaker.deadline`. All
+        the bucket calls of :class:`couchbasekit.document.Document` are made
+        through here::
+
+            flags, cas, data = Connection.call('mybucket', 'get', ('author_kirpit',))
+
+        The driver calls can't be interrupted, so operations with a time
+        limit are run in a helper thread and abandoned when they are late.
+        The bucket handle is dropped then, as its socket is in an unknown
+        state, and the next call opens a new one.
+
+        :param bucket_name: Bucket name.
+        :type bucket_name: str
+        :param operation: Bucket method name, or a callable to be called
+            with the bucket as its first argument.
+        :type operation: str or callable
+        :param args: Operation arguments, defaults to none.
+        :type args: tuple
+        :param timeout: Time limit of the operation in seconds, defaults to
+            None (only the current deadline, if any).
+        :type timeout: float
+        :returns: Result of the operation.
+        :raises: :exc:`couchbasekit.errors.CircuitOpen`,
+            :exc:`couchbasekit.errors.OperationTimeout` or any error of the
+            operation itself.
+        """
+        name = operation if isinstance(operation, basestring) \
+               else getattr(operation, '__name__', 'call')
+        left = remaining(timeout)
+        # not even tried, so not the bucket's fault
+        if left is not None and left <= 0:
+            raise OperationTimeout(bucket_name, name)
+        breaker = cls.breaker(bucket_name)
+        if not breaker.allow():
+            raise CircuitOpen(bucket_name)
+        try:
+            bucket = cls.bucket(bucket_name)
+            if isinstance(operation, basestring):
+                func, func_args = getattr(bucket, operation), args
+            else:
+                func, func_args = operation, (bucket,) + tuple(args)
+            if left is None:
+                result = func(*func_args)
+            else:
+                result = cls._call_within(
+                    bucket_name, bucket, name, left, func, func_args
+                )
+        except _memcached_error():
+            # the server has answered
+            breaker.succeeded()
+            raise
+        except Exception:
+            breaker.failed()
+            raise
+        breaker.succeeded()
+        return result
+
+    @classmethod
+    def _call_within(cls, bucket_name, bucket, name, seconds, func, args):
+        outcome = dict()
+
+        def _run():
+            try:
+                outcome['result'] = func(*args)
+            except Exception as why:
+                outcome['error'] = why
+
+        thread = threading.Thread(target=_run)
+        thread.daemon = True
+        thread.start()
+        thread.join(seconds)
+        if thread.is_alive():
+            cls._discard(bucket_name, bucket)
+            raise OperationTimeout(bucket_name, name)
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['result']
@@ -7,15 +7,120 @@ couchbasekit.document
 :copyright: Copyright 2013, Roy Enjoy <kirpit *at* gmail.com>, see AUTHORS.txt.
 :license: MIT, see LICENSE.txt for details.
 """
+from abc import ABCMeta
 import datetime
-import hashlib
-import jsonpickle
-from dateutil.tz import tzutc
-from couchbase.exception import MemcachedError
 from couchbasekit import Connection
+from couchbasekit.connection import _memcached_error
+from couchbasekit.breaker import deadline
 from couchbasekit.schema import SchemaDocument
-from couchbasekit.errors import DoesNotExist
-from couchbasekit.fields import CustomField
+from couchbasekit.compression import decompress
+from couchbasekit.errors import DoesNotExist, KeyExists, StructureError, \
+    OperationTimeout, CircuitOpen
+from couchbasekit.fields import CustomField, ChunkedListField
+from couchbasekit.keygen import UUIDKey
+from couchbasekit.sharding import ConsistentHashRouter
+
+
+def _jsonpickle():
+    # imported on the first encode/decode, not with couchbasekit
+    import jsonpickle
+    return jsonpickle
+
+
+def _split_alias(alias):
+    # 'alias', ('alias', {nested}) or {nested}
+    if isinstance(alias, tuple):
+        return alias
+    elif isinstance(alias, dict):
+        return None, alias
+    return alias, None
+
+
+def _reverse_aliases(aliases, structure):
+    reverse = dict()
+    for key, alias in aliases.iteritems():
+        alias, nested = _split_alias(alias)
+        stored = alias or key
+        if stored in reverse:
+            raise StructureError(
+                msg="Field alias '%s' is used more than once." % stored
+            )
+        # un-aliased fields are stored by their own names
+        if stored!=key and stored in structure and stored not in aliases:
+            raise StructureError(
+                msg="Field alias '%s' is also a field name." % stored
+            )
+        if nested:
+            nested_structure = structure.get(key)
+            if not isinstance(nested_structure, dict):
+                nested_structure = dict()
+            nested = _reverse_aliases(nested, nested_structure)
+        reverse[stored] = (key, nested)
+    return reverse
+
+
+def _alias_dict(mapping, aliases):
+    data = dict()
+    for key, value in mapping.iteritems():
+        if key in aliases:
+            alias, nested = _split_alias(aliases[key])
+            if nested and isinstance(value, dict):
+                value = _alias_dict(value, nested)
+            key = alias or key
+        data[key] = value
+    return data
+
+
+def _unalias_dict(mapping, reverse):
+    data = dict()
+    for key, value in mapping.iteritems():
+        if key in reverse:
+            key, nested = reverse[key]
+            if nested and isinstance(value, dict):
+                value = _unalias_dict(value, nested)
+        data[key] = value
+    return data
+
+
+def _multi_get(bucket, doc_ids):
+    get_multi = getattr(bucket, 'getMulti', None)
+    if get_multi is not None:
+        return get_multi(doc_ids)
+    # one by one, then
+    found = dict()
+    for doc_id in doc_ids:
+        try:
+            found[doc_id] = bucket.get(doc_id)
+        except _memcached_error() as why:
+            # raise if other than "not found"
+            if why.status!=1:
+                raise why
+    return found
+
+
+_default_router = ConsistentHashRouter()
+
+# (bucket name, doc_type) -> model document class
+_registry = dict()
+# bucket name -> stored names (i.e. aliases) of the doc_type field
+_doc_type_fields = dict()
+
+
+class DocumentMeta(ABCMeta):
+    """Metaclass of :class:`Document` that registers every model document
+    with its own ``__bucket_name__`` and ``doc_type`` at the time of class
+    creation, see :meth:`Document.from_raw`.
+    """
+    def __init__(cls, name, bases, attrs):
+        super(DocumentMeta, cls).__init__(name, bases, attrs)
+        if ('__bucket_name__' in attrs or 'doc_type' in attrs) and \
+           cls.__bucket_name__ and cls.doc_type:
+            _registry[(cls.__bucket_name__, cls.doc_type)] = cls
+            field = _split_alias(cls.aliases.get('doc_type'))[0] or 'doc_type'
+            _doc_type_fields.setdefault(cls.__bucket_name__, set()).add(field)
+        if cls.aliases and ('aliases' in attrs or 'structure' in attrs):
+            # conflicting aliases raise at the class definition
+            cls._get_reverse_aliases()
 
 
 class Document(SchemaDocument):
@@ -33,14 +138,32 @@ class Document(SchemaDocument):
     :raises: :exc:`couchbasekit.errors.StructureError` or
         :exc:`couchbasekit.errors.DoesNotExist`
     """
+    __metaclass__ = DocumentMeta
     DoesNotExist = DoesNotExist
+    KeyExists = KeyExists
+    OperationTimeout = OperationTimeout
+    CircuitOpen = CircuitOpen
     __bucket_name__ = None
     __view_name__ = None
+    __key_generator__ = UUIDKey()
+    __codec__ = None
+    __schema_version__ = None
+    __write_behind__ = None
+    __negative_cache__ = None
+    __replica_read__ = None
+    __timeout__ = None
+    __bucket_names__ = None
+    __shard_router__ = None
     _hashed_key = None
+    _shard = None
     _view_design_doc = None
     _view_cache = None
     full_set = False
     cas_value = None
+    migrated_from = None
+    from_replica = False
+    _stored_values = None
+    _raw_data = None
 
     def __init__(self, key_or_map=None, get_lock=False, **kwargs):
         # check document schema first
@@ -74,6 +197,12 @@ class Document(SchemaDocument):
         # raise AttributeError eventually:
         return super(Document, self).__getattribute__(item)
 
+    def _decode_field(self, item, expose=True):
+        value = super(Document, self)._decode_field(item, expose)
+        if isinstance(value, ChunkedListField):
+            value.bind(self)
+        return value
+
     def __setattr__(self, key, value):
         if key in self.structure:
             self[unicode(key)] = value
@@ -95,8 +224,8 @@ class Document(SchemaDocument):
         """Returns the couchbase document's id, object property.
 
         :returns: The document id (that is created from :attr:`doc_type` and
-            :attr:`__key_field__` value, or auto-hashed document id at first
-            saving).
+            :attr:`__key_field__` value, or by :attr:`__key_generator__` at
+            first saving).
         :rtype: unicode
         """
         if self.id:
@@ -110,7 +239,29 @@ class Document(SchemaDocument):
         :returns: See: :class:`couchbase.client.Bucket`.
         :rtype: :class:`couchbase.client.Bucket`
         """
-        return Connection.bucket(self.__bucket_name__)
+        return Connection.bucket(self._shard or self._route(self.doc_id))
+
+    @classmethod
+    def _shards(cls):
+        return tuple(cls.__bucket_names__ or (cls.__bucket_name__,))
+
+    @classmethod
+    def _route(cls, doc_id):
+        if not cls.__bucket_names__ or doc_id is None:
+            return cls.__bucket_name__
+        router = cls.__shard_router__ or _default_router
+        return router(doc_id, tuple(cls.__bucket_names__))
+
+    @classmethod
+    def _call(cls, operation, *args):
+        # every bucket call goes through the breaker and deadlines
+        return Connection.call(cls.__bucket_name__, operation, args, cls.__timeout__)
+
+    def _doc_call(self, operation, *args):
+        # documents themselves live in their shard
+        return Connection.call(
+            self._route(self.doc_id), operation, args, self.__timeout__
+        )
 
     def view(self, view_name=None):
         """Returns a couchbase view (or design document view with no view_name
@@ -151,24 +302,520 @@ class Document(SchemaDocument):
                     self._view_cache.append(view)
         return next(iter([v for v in self._view_cache if v.name==view_name]), None)
 
+    @classmethod
+    def iter_view(cls, view_name, batch_size=100, params=None, bucket_name=None):
+        """Iterates over all the rows of a (map only) view, fetching them page
+        by page, so it is safe to go through millions of rows::
+
+            for row in Book.iter_view('by_title', params={'stale': 'ok'}):
+                print row['id'], row['key']
+
+        Views of the sharded models (see :attr:`__bucket_names__`) are
+        queried bucket by bucket, so the rows are sorted within each bucket
+        only.
+
+        :param view_name: Name of the view within the model's design document.
+        :type view_name: str
+        :param batch_size: Number of rows to be fetched per request,
+            defaults to 100.
+        :type batch_size: int
+        :param params: Extra view query parameters, defaults to None.
+        :type params: dict
+        :param bucket_name: Query only this bucket, defaults to None that is
+            all the buckets of the model.
+        :type bucket_name: str
+        :returns: Generator of view rows.
+        :raises: :exc:`RuntimeError` if the view was not found.
+        """
+        bucket_names = (bucket_name,) if bucket_name else cls._shards()
+        for bucket_name in bucket_names:
+            view = cls._shard_view(bucket_name, view_name)
+            shard_params = dict(params or {})
+            shard_params['limit'] = batch_size
+            while True:
+                result = Connection.call(
+                    bucket_name, lambda bucket: view.results(dict(shard_params)),
+                    timeout=cls.__timeout__,
+                )
+                rows = result.get('rows', []) if isinstance(result, dict) else result
+                for row in rows:
+                    yield row
+                if len(rows) < batch_size:
+                    break
+                # continue right after the last row
+                shard_params.update(
+                    startkey=rows[-1]['key'],
+                    startkey_docid=rows[-1]['id'],
+                    skip=1,
+                )
+
+    @classmethod
+    def _shard_view(cls, bucket_name, view_name):
+        doc = cls()
+        doc._shard = bucket_name
+        view = doc.view(view_name)
+        if view is None:
+            raise RuntimeError("View '%s' of %s not found."
+                               % (view_name, cls.__name__))
+        return view
+
+    @classmethod
+    def from_doc_id(cls, doc_id, get_lock=False):
+        """Fetches a document by its couchbase document id, rather than its
+        key field value.
+
+        :param doc_id: Couchbase document id, such as ``'author_kirpit'``.
+        :type doc_id: basestring
+        :param get_lock: See :class:`Document`.
+        :type get_lock: bool
+        :returns: The fetched document.
+        :raises: :exc:`couchbasekit.errors.DoesNotExist`
+        """
+        if cls.__key_field__:
+            # strip "{doc_type}_" prefix
+            doc_id = doc_id[len(cls.doc_type)+1:]
+        return cls(doc_id, get_lock)
+
+    @classmethod
+    def migration(cls, from_version):
+        """Decorator to register a schema migration function of the model,
+        which takes the raw document data of ``from_version`` and returns it
+        upgraded to the next version. Unstamped documents are version ``0``::
+
+            class Author(Document):
+                __schema_version__ = 1
+                # snip snip
+
+            @Author.migration(0)
+            def split_name(data):
+                first, last = data.pop('name').split(' ', 1)
+                data.update(first_name=first, last_name=last)
+                return data
+
+        :param from_version: The schema version that the function upgrades.
+        :type from_version: int
+        """
+        def _register(func):
+            # don't touch the parent's migrations
+            if 'migrations' not in cls.__dict__:
+                cls.migrations = dict(cls.migrations)
+            cls.migrations[from_version] = func
+            return func
+        return _register
+
+    def _migrate(self, data):
+        version = data.get(u'doc_version') or 0
+        if self.__schema_version__ is None or version >= self.__schema_version__:
+            return data
+        self.migrated_from = version
+        while version < self.__schema_version__:
+            if version not in self.migrations:
+                raise self.StructureError(
+                    msg="No migration is registered for %s from "
+                        "version %d." % (type(self).__name__, version)
+                )
+            data = self.migrations[version](data)
+            version += 1
+        data[u'doc_version'] = version
+        return data
+
+    @classmethod
+    def _storage_key(cls, name, value):
+        if isinstance(value, basestring):
+            value = value.lower()
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        # urllib loads socket and ssl, so not with couchbasekit
+        from urllib import quote
+        return '%s_%s_%s' % (cls.doc_type, name, quote(str(value), '@'))
+
+    @classmethod
+    def _lookup_key(cls, field, value):
+        return cls._storage_key(field, value)
+
+    @classmethod
+    def _aggregate_key(cls, name, group):
+        return cls._storage_key('agg_%s' % name, group)
+
+    def _tracked_values(self, mapping):
+        # encoded values of the fields that indexes and aggregates depend on
+        fields = set(self.indexes)
+        for aggregate in self.aggregates.itervalues():
+            fields.add(aggregate['group_by'])
+            if aggregate.get('sum'):
+                fields.add(aggregate['sum'])
+        values = dict()
+        for field in fields:
+            if mapping is self:
+                value = self._current_value(field)
+            else:
+                value = mapping.get(field)
+            if value is not None:
+                values[field] = self._encode_item(value)
+        return values
+
+    def _lookup_keys(self, values):
+        return dict(
+            (field, self._lookup_key(field, values[field]))
+            for field in self.indexes if field in values
+        )
+
+    @staticmethod
+    def _lookup_value(doc_id):
+        # lookups keep the document ids utf-8 encoded
+        if isinstance(doc_id, unicode):
+            doc_id = doc_id.encode('utf-8')
+        return doc_id
+
+    def _add_lookup(self, lookup_key):
+        doc_id = self._lookup_value(self.doc_id)
+        try:
+            self._call('add', lookup_key, 0, 0, doc_id)
+        except _memcached_error() as why:
+            # raise if other than "key exists"
+            if why.status!=2:
+                raise why
+            status, cas, owner_id = self._call('get', lookup_key)
+            # might be ours, left behind by a failed save
+            if owner_id==doc_id:
+                return
+            if self._owns_lookup(owner_id, lookup_key):
+                raise self.KeyExists(self, lookup_key)
+            # stale, left behind by a failed save of another document, so
+            # take it over unless it has changed in the meantime
+            try:
+                self._call('delete', lookup_key, cas)
+                self._call('add', lookup_key, 0, 0, doc_id)
+            except _memcached_error() as why:
+                # "key exists" (or CAS mismatch) if taken in the meantime
+                if why.status==2:
+                    raise self.KeyExists(self, lookup_key)
+                # raise if other than "not found", already gone then
+                if why.status!=1:
+                    raise why
+                self._call('add', lookup_key, 0, 0, doc_id)
+
+    def _owns_lookup(self, owner_id, lookup_key):
+        # does the owner document still hold the value, just like get_by()
+        try:
+            owner = self.from_doc_id(owner_id)
+        except self.DoesNotExist:
+            return False
+        return lookup_key in owner._lookup_keys(
+            owner._tracked_values(owner)
+        ).values()
+
+    def _delete_lookup(self, lookup_key, owner_id=None):
+        if owner_id is None:
+            owner_id = self.doc_id
+        owner_id = self._lookup_value(owner_id)
+        try:
+            status, cas, doc_id = self._call('get', lookup_key)
+            # never delete somebody else's lookup
+            if doc_id==owner_id:
+                self._call('delete', lookup_key, cas)
+        except _memcached_error() as why:
+            # raise if other than "not found"
+            if why.status!=1:
+                raise why
+
+    @classmethod
+    def get_by(cls, field, value):
+        """Fetches a document by one of its :attr:`indexes` fields, using the
+        lookup documents that are maintained at the time of saving. It costs
+        two key-value gets and no view query::
+
+            author = Author.get_by('email', 'kirpit@gmail.com')
+
+        :param field: Indexed field name.
+        :type field: str
+        :param value: Field value to be looked up.
+        :returns: The fetched document.
+        :raises: :exc:`couchbasekit.errors.StructureError` if the field is not
+            indexed or :exc:`couchbasekit.errors.DoesNotExist`
+        """
+        if field not in cls.indexes:
+            raise cls.StructureError(
+                msg="'%s' is not an indexed field of %s." % (field, cls.__name__)
+            )
+        lookup_doc = cls()
+        lookup_key = cls._lookup_key(field, lookup_doc._encode_item(value))
+        try:
+            doc_id = cls._call('get', lookup_key)[2]
+        except _memcached_error() as why:
+            # raise if other than "not found"
+            if why.status!=1:
+                raise why
+            lookup_doc._hashed_key = lookup_key
+            raise cls.DoesNotExist(lookup_doc)
+        doc = cls.from_doc_id(doc_id)
+        # lookup might be stale after a failure
+        if doc._lookup_keys(doc._tracked_values(doc)).get(field)!=lookup_key:
+            lookup_doc._hashed_key = lookup_key
+            raise cls.DoesNotExist(lookup_doc)
+        return doc
+
+    def _incr_aggregate(self, name, group, amount):
+        aggregate_key = self._aggregate_key(name, group)
+        if amount > 0:
+            self._call('incr', aggregate_key, amount, amount)
+        elif amount < 0:
+            self._call('decr', aggregate_key, -amount, 0)
+
+    def _update_aggregates(self, old, new):
+        # old is None for new documents, new is None for deleted ones
+        for name, aggregate in self.aggregates.iteritems():
+            group_by, sum_field = aggregate['group_by'], aggregate.get('sum')
+            old_group = old.get(group_by) if old is not None else None
+            new_group = new.get(group_by) if new is not None else None
+            if sum_field:
+                old_amount = (old.get(sum_field) or 0) if old is not None else 0
+                new_amount = (new.get(sum_field) or 0) if new is not None else 0
+            else:
+                old_amount = 1 if old is not None else 0
+                new_amount = 1 if new is not None else 0
+            if old_group==new_group:
+                if new_group is not None:
+                    self._incr_aggregate(name, new_group, new_amount-old_amount)
+                continue
+            if old_group is not None:
+                self._incr_aggregate(name, old_group, -old_amount)
+            if new_group is not None:
+                self._incr_aggregate(name, new_group, new_amount)
+
+    @classmethod
+    def aggregate(cls, name, group):
+        """Returns the current value of one of the model's :attr:`aggregates`
+        for a group, with a single key-value get::
+
+            >>> Author.aggregate('per_publisher', publisher)
+            42
+
+        :param name: Aggregate name.
+        :type name: str
+        :param group: The value of the ``group_by`` field, such as a related
+            document.
+        :returns: The count or sum, 0 if nothing was saved for the group.
+        :rtype: int
+        :raises: :exc:`couchbasekit.errors.StructureError` if the aggregate
+            is not defined.
+        """
+        if name not in cls.aggregates:
+            raise cls.StructureError(
+                msg="'%s' is not an aggregate of %s." % (name, cls.__name__)
+            )
+        doc = cls()
+        try:
+            value = cls._call('get', cls._aggregate_key(name, doc._encode_item(group)))[2]
+        except _memcached_error() as why:
+            # raise if other than "not found"
+            if why.status!=1:
+                raise why
+            return 0
+        return int(value)
+
     def _fetch_data(self, get_lock=False):
+        negative_cache = self.__negative_cache__
+        if negative_cache is not None:
+            miss_key = (self.__bucket_name__, self.doc_id)
+            # missing a moment ago
+            if miss_key in negative_cache:
+                return False
         try:
             if get_lock is True:
-                status, self.cas_value, data = self.bucket.getl(self.doc_id)
+                flags, self.cas_value, data = self._doc_call('getl', self.doc_id)
+            elif self.__replica_read__ is not None:
+                flags, self.cas_value, data, self.from_replica = \
+                    self._doc_call(self.__replica_read__.get, self.doc_id)
             else:
-                status, self.cas_value, data = self.bucket.get(self.doc_id)
-        except MemcachedError as why:
+                flags, self.cas_value, data = self._doc_call('get', self.doc_id)
+        except _memcached_error() as why:
             # raise if other than "not found"
             if why.status!=1:
                 raise why
+            if negative_cache is not None:
+                negative_cache.add(miss_key)
         else:
             # found within couchbase
-            self.is_new_record = False
-            data = jsonpickle.decode(data)
-            self.update(data)
+            self._load(flags, data)
         # return is_fetched in other words:
         return not self.is_new_record
 
+    def _load(self, flags, data):
+        self._load_data(_jsonpickle().decode(decompress(flags, data)))
+
+    def _load_data(self, data):
+        self.is_new_record = False
+        if self.aliases:
+            data = _unalias_dict(data, self._get_reverse_aliases())
+        data = self._migrate(data)
+        if self.indexes or self.aggregates:
+            self._stored_values = self._tracked_values(data)
+        self.update(data)
+        # untouched values will be saved back as they are
+        self._raw_data = data
+
+    @classmethod
+    def _from_fetched(cls, doc_id, flags, cas_value, data):
+        return cls._from_data(
+            doc_id, cas_value, _jsonpickle().decode(decompress(flags, data))
+        )
+
+    @classmethod
+    def _from_data(cls, doc_id, cas_value, data):
+        # fast path for trusted (fetched) data
+        doc = cls._new()
+        if not cls.__key_field__:
+            doc.__dict__['_hashed_key'] = doc_id
+        doc.__dict__['cas_value'] = cas_value
+        doc._load_data(data)
+        return doc
+
+    @classmethod
+    def from_raw(cls, data, cas_value=None, doc_id=None, bucket_name=None):
+        """Builds the right model document instance out of a raw couchbase
+        document (such as view rows, bulk fetches or exports) by looking up
+        its ``doc_type`` in the registry of model documents, without knowing
+        the model in advance::
+
+            for row in rows:
+                doc = Document.from_raw(row['doc']['json'], doc_id=row['id'])
+
+        :param data: Raw document, either decoded or JSON string.
+        :type data: dict or basestring
+        :param cas_value: CAS value of the document, defaults to None.
+        :type cas_value: int
+        :param doc_id: Couchbase document id, required for the models without
+            a ``__key_field__``.
+        :type doc_id: basestring
+        :param bucket_name: The bucket that the document belongs to, defaults
+            to the bucket of the class it is called on.
+        :type bucket_name: str
+        :returns: The model document instance.
+        :raises: :exc:`couchbasekit.errors.StructureError` if no model was
+            registered for the document, or ``doc_id`` is missing for a model
+            without a ``__key_field__``.
+        """
+        if isinstance(data, basestring):
+            data = _jsonpickle().decode(data)
+        bucket_name = bucket_name or cls.__bucket_name__
+        model = None
+        for field in _doc_type_fields.get(bucket_name, ()):
+            if field in data:
+                model = _registry.get((bucket_name, data[field]))
+                if model is not None:
+                    break
+        if model is None:
+            raise cls.StructureError(
+                msg="No model document is registered for the raw "
+                    "document in '%s' bucket." % bucket_name
+            )
+        if doc_id is None and not model.__key_field__:
+            raise cls.StructureError(
+                msg="Document id is required to build %s documents from "
+                    "raw data." % model.__name__
+            )
+        return model._from_data(doc_id, cas_value, data)
+
+    @classmethod
+    def get_multi(cls, doc_ids):
+        """Fetches many documents by their couchbase document ids, with a single
+        multi-get request if the couchbase driver supports it.
+
+        :param doc_ids: Couchbase document ids, such as ``'author_kirpit'``.
+        :type doc_ids: list
+        :returns: Dictionary of document ids to the found documents, missing
+            ones are not included.
+        :rtype: dict
+        """
+        # one multi-get per shard
+        by_bucket = dict()
+        for doc_id in set(doc_ids):
+            by_bucket.setdefault(cls._route(doc_id), list()).append(doc_id)
+        found = dict()
+        for bucket_name, bucket_doc_ids in by_bucket.iteritems():
+            found.update(Connection.call(
+                bucket_name, _multi_get, (bucket_doc_ids,), cls.__timeout__
+            ))
+        found = found.items()
+        docs = cls.hydrate_many(
+            [_jsonpickle().decode(decompress(flags, data))
+             for doc_id, (flags, cas_value, data) in found],
+            doc_ids=[doc_id for doc_id, item in found],
+            cas_values=[item[1] for doc_id, item in found],
+        )
+        return dict((doc.doc_id, doc) for doc in docs)
+
+    @classmethod
+    def hydrate_many(cls, raws, doc_ids=None, cas_values=None):
+        """Builds many documents of the model out of their raw (decoded JSON)
+        data at once, such as view rows with ``include_docs`` or bulk
+        exports::
+
+            books = Book.hydrate_many(
+                [row['doc']['json'] for row in rows],
+                doc_ids=[row['id'] for row in rows],
+            )
+
+        Fields are decoded column by column rather than document by
+        document, so each distinct datetime value is parsed and each distinct
+        :class:`couchbasekit.fields.ChoiceField` value is validated only once.
+        The rest of the fields are decoded on access, as usual.
+
+        :param raws: Raw documents of the model.
+        :type raws: list
+        :param doc_ids: Couchbase document ids in the same order, required
+            for the models without a ``__key_field__``, defaults to None.
+        :type doc_ids: list
+        :param cas_values: CAS values in the same order, defaults to None.
+        :type cas_values: list
+        :returns: The model document instances in the same order.
+        :rtype: list
+        """
+        doc_ids = doc_ids or [None] * len(raws)
+        cas_values = cas_values or [None] * len(raws)
+        docs = [
+            cls._from_data(doc_id, cas_value, data)
+            for doc_id, cas_value, data in zip(doc_ids, cas_values, raws)
+        ]
+        cls._decode_columns(docs)
+        return docs
+
+    @classmethod
+    def query_keys(cls, view_name, keys, params=None):
+        """Queries a view for many keys with a single request (using the
+        ``keys`` view parameter) and fetches all the emitted documents with
+        a single multi-get, see :meth:`get_multi`. That's one view call plus
+        one bulk key-value call instead of one of each per key::
+
+            books = Book.query_keys('by_author', keys=['author_kirpit', 'author_roy'])
+
+        :param view_name: Name of the view within the model's design document.
+        :type view_name: str
+        :param keys: View keys to be queried.
+        :type keys: list
+        :param params: Extra view query parameters, defaults to None.
+        :type params: dict
+        :returns: Documents in the order of the view rows (bucket by bucket
+            for the sharded models), the ones that were deleted in the
+            meantime are skipped.
+        :rtype: list
+        :raises: :exc:`RuntimeError` if the view was not found.
+        """
+        params = dict(params or {})
+        params['keys'] = list(keys)
+        doc_ids = list()
+        for bucket_name in cls._shards():
+            view = cls._shard_view(bucket_name, view_name)
+            result = Connection.call(
+                bucket_name, lambda bucket: view.results(params),
+                timeout=cls.__timeout__,
+            )
+            rows = result.get('rows', []) if isinstance(result, dict) else result
+            doc_ids.extend(row['id'] for row in rows)
+        docs = cls.get_multi(doc_ids)
+        return [docs[doc_id] for doc_id in doc_ids if doc_id in docs]
+
     def _encode_item(self, value):
         # Document instance
         if isinstance(value, Document):
@@ -183,10 +830,11 @@ class Document(SchemaDocument):
             return value.value
         # datetime types
         elif isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+            from dateutil.tz import tzutc
             if hasattr(value, 'tzinfo') and value.tzinfo is None:
                 # always timezone "aware" datetime and time
                 value = value.replace(tzinfo=tzutc())
-            pickler = jsonpickle.Pickler(unpicklable=False)
+            pickler = _jsonpickle().Pickler(unpicklable=False)
             return pickler.flatten(value)
         # list
         elif isinstance(value, list):
@@ -197,7 +845,7 @@ class Document(SchemaDocument):
         # no need to encode
         return value
 
-    def _encode_dict(self, mapping):
+    def _encode_dict(self, mapping, aliases=None):
         data = dict()
         for key, value in mapping.iteritems():
             # None values will be stripped out
@@ -209,60 +857,228 @@ class Document(SchemaDocument):
                 # should raise an error here
                 pass
             key = self._encode_item(key)
-            data[key] = self._encode_item(value)
+            # no storage aliases at this level
+            if not aliases or key not in aliases:
+                data[key] = self._encode_item(value)
+                continue
+            alias, nested = _split_alias(aliases[key])
+            if nested and isinstance(value, dict):
+                data[alias or key] = self._encode_dict(value, nested)
+            else:
+                data[alias or key] = self._encode_item(value)
         return data
 
-    def save(self, expiration=0):
-        """Saves the current instance after validating it.
+    def _changed_keys(self):
+        # untouched values of a fetched document are trusted
+        if self._raw_data is None or self.migrated_from is not None:
+            return None
+        raw_data = self._raw_data
+        exposed = self._exposed or ()
+        return [
+            key for key, value in self.iteritems()
+            if key in exposed or key not in raw_data or raw_data[key] is not value
+        ]
 
-        :param expiration: Expiration in seconds for the document to be removed by
-            couchbase server, defaults to 0 - will never expire.
-        :type expiration: int
-        :returns: couchbase document CAS value
-        :rtype: int
-        :raises: :exc:`couchbasekit.errors.StructureError`,
-            See :meth:`couchbasekit.schema.SchemaDocument.validate`.
-        """
+    def _current_value(self, key):
+        # decoded one if any, as it might be modified in-place
+        value = self.get(key)
+        if self._decoded is not None and key in self._decoded and \
+           self._decoded[key][0] is value:
+            return self._decoded[key][1]
+        return value
+
+    def _encode_document(self):
+        raw_data = self._raw_data or {}
+        exposed = self._exposed or ()
+        raw, changed = dict(), dict()
+        for key, value in self.iteritems():
+            # untouched since fetched, already json safe
+            if key not in exposed and key in raw_data and raw_data[key] is value:
+                if value is not None:
+                    raw[key] = value
+            else:
+                changed[key] = self._current_value(key)
+        json_safe = self._encode_dict(changed, self.aliases)
+        # raw ones are only renamed
+        if raw and self.aliases:
+            raw = _alias_dict(raw, self.aliases)
+        json_safe.update(raw)
+        return json_safe
+
+    @classmethod
+    def _get_reverse_aliases(cls):
+        # computed once per model class
+        if '_reverse_aliases' not in cls.__dict__:
+            cls._reverse_aliases = _reverse_aliases(
+                cls.aliases, dict(cls.structure, doc_type=None, doc_version=None)
+            )
+        return cls._reverse_aliases
+
+    def _prepare(self):
         # set the default values first
         for key, value in self.default_values.iteritems():
             if callable(value): value = value()
             self.setdefault(key, value)
         # validate
         self[u'doc_type'] = unicode(self.doc_type)
+        if self.__schema_version__ is not None:
+            self[u'doc_version'] = self.__schema_version__
         self.validate()
-        # json safe data
-        json_safe = self._encode_dict(self)
-        json_data = jsonpickle.encode(json_safe, unpicklable=False)
         # still no document id? create one..
         if self.doc_id is None:
-            self._hashed_key = hashlib.sha1(json_data).hexdigest()[0:12]
-        # finally
-        self.cas_value = self.bucket.set(self.doc_id, expiration, 0, json_data)[1]
+            self._hashed_key = self.__key_generator__(self)
+        # json safe data
+        json_safe = self._encode_document()
+        return _jsonpickle().encode(json_safe, unpicklable=False)
+
+    def _write(self, expiration, json_data, cas_value=None):
+        flags = 0
+        if self.__codec__ is not None:
+            flags, json_data = self.__codec__.encode(json_data)
+        # generated keys must not over-write anything
+        if self.is_new_record and not self.__key_field__:
+            try:
+                self.cas_value = self._doc_call(
+                    'add', self.doc_id, expiration, flags, json_data
+                )[1]
+            except _memcached_error() as why:
+                # raise if other than "key exists"
+                if why.status!=2:
+                    raise why
+                error = self.KeyExists(self)
+                self._hashed_key = None
+                raise error
+        elif cas_value is not None:
+            # only if unchanged since it was fetched
+            self.cas_value = self._doc_call(
+                'cas', self.doc_id, expiration, flags, cas_value, json_data
+            )[1]
+        else:
+            self.cas_value = self._doc_call(
+                'set', self.doc_id, expiration, flags, json_data
+            )[1]
+        if self.__negative_cache__ is not None:
+            self.__negative_cache__.discard((self.__bucket_name__, self.doc_id))
+        return self.cas_value
+
+    def _previous_values(self):
+        try:
+            flags, cas_value, data = self._doc_call('get', self.doc_id)
+        except _memcached_error() as why:
+            # raise if other than "not found"
+            if why.status!=1:
+                raise why
+            return None
+        return self._from_fetched(
+            self.doc_id, flags, cas_value, data
+        )._stored_values
+
+    def _store(self, expiration, json_data, cas_value=None):
+        if not self.indexes and not self.aggregates:
+            self._write(expiration, json_data, cas_value)
+        else:
+            values = self._tracked_values(self)
+            stored = self._stored_values
+            if stored is None and \
+               not (self.is_new_record and not self.__key_field__):
+                # over-writing a document that wasn't fetched, such as a
+                # new instance with an existing __key_field__ value
+                stored = self._previous_values()
+            lookups = self._lookup_keys(values).values()
+            stored_lookups = self._lookup_keys(stored or {}).values()
+            # reserve the new lookups first for uniqueness
+            reserved = list()
+            # a generated id is cleared by _write() if it was taken
+            doc_id = self.doc_id
+            try:
+                for lookup_key in lookups:
+                    if lookup_key not in stored_lookups:
+                        self._add_lookup(lookup_key)
+                        reserved.append(lookup_key)
+                self._write(expiration, json_data, cas_value)
+            except Exception:
+                for lookup_key in reserved:
+                    self._delete_lookup(lookup_key, doc_id)
+                raise
+            # release the old ones
+            for lookup_key in stored_lookups:
+                if lookup_key not in lookups:
+                    self._delete_lookup(lookup_key)
+            self._update_aggregates(stored, values)
+            self._stored_values = values
+        self.is_new_record = False
+        self.migrated_from = None
         return self.cas_value
 
-    def delete(self):
+    def save(self, expiration=0, timeout=None):
+        """Saves the current instance after validating it.
+
+        If the model has a :attr:`__write_behind__` buffer (see
+        :class:`couchbasekit.writebehind.WriteBehind`), the document is only
+        queued to be written later by that buffer.
+
+        :param expiration: Expiration in seconds for the document to be removed by
+            couchbase server, defaults to 0 - will never expire.
+        :type expiration: int
+        :param timeout: Seconds for all the couchbase calls of the save
+            (including the lookups and aggregates) to complete, defaults to
+            None - see :attr:`__timeout__`.
+        :type timeout: float
+        :returns: couchbase document CAS value, or None if it was queued.
+        :rtype: int
+        :raises: :exc:`couchbasekit.errors.StructureError`,
+            See :meth:`couchbasekit.schema.SchemaDocument.validate`, or
+            :exc:`couchbasekit.errors.KeyExists` if the generated document id
+            or a unique :attr:`indexes` value was taken already, or
+            :exc:`couchbasekit.errors.OperationTimeout`
+        """
+        with deadline(timeout):
+            json_data = self._prepare()
+            if self.__write_behind__ is not None:
+                self.__write_behind__.put(self, expiration, json_data)
+                return None
+            # finally
+            return self._store(expiration, json_data)
+
+    def delete(self, timeout=None):
         """Deletes the current document explicitly with CAS value.
 
+        :param timeout: Seconds for the delete to complete, defaults to None
+            - see :attr:`__timeout__`.
+        :type timeout: float
         :returns: Response from CouchbaseClient.
         :rtype: unicode
-        :raises: :exc:`couchbasekit.errors.DoesNotExist` or
+        :raises: :exc:`couchbasekit.errors.DoesNotExist`,
+            :exc:`couchbasekit.errors.OperationTimeout` or
             :exc:`couchbase.exception.MemcachedError`
         """
         if not self.cas_value or not self.doc_id:
             raise self.DoesNotExist(self)
-        return self.bucket.delete(self.doc_id, self.cas_value)
+        with deadline(timeout):
+            response = self._doc_call('delete', self.doc_id, self.cas_value)
+            if self._stored_values is not None:
+                for lookup_key in self._lookup_keys(self._stored_values).itervalues():
+                    self._delete_lookup(lookup_key)
+                self._update_aggregates(self._stored_values, None)
+                self._stored_values = None
+        return response
 
-    def touch(self, expiration):
+    def touch(self, expiration, timeout=None):
         """Updates the current document's expiration value.
 
         :param expiration: Expiration in seconds for the document to be removed by
             couchbase server, defaults to 0 - will never expire.
         :type expiration: int
+        :param timeout: Seconds for the touch to complete, defaults to None
+            - see :attr:`__timeout__`.
+        :type timeout: float
         :returns: Response from CouchbaseClient.
         :rtype: unicode
-        :raises: :exc:`couchbasekit.errors.DoesNotExist` or
+        :raises: :exc:`couchbasekit.errors.DoesNotExist`,
+            :exc:`couchbasekit.errors.OperationTimeout` or
             :exc:`couchbase.exception.MemcachedError`
         """
         if not self.cas_value or not self.doc_id:
             raise self.DoesNotExist(self)
-        return self.bucket.touch(self.doc_id, expiration)
\ No newline at end of file
+        with deadline(timeout):
+            return self._doc_call('touch', self.doc_id, expiration)
\ No newline at end of file
@@ -35,6 +35,49 @@ class DoesNotExist(CouchbasekitException):
         super(DoesNotExist, self).__init__(msg)
 
 
+class KeyExists(CouchbasekitException):
+    """Raised when a new document with an auto-generated id is being saved,
+    but another document with the same id exists within couchbase already.
+    It is also raised when a unique ``indexes`` field value was taken by
+    another document.
+
+    Just like :exc:`DoesNotExist`, it is also attached to your model documents
+    as ``Author.KeyExists`` for convenience.
+    """
+    def __init__(self, doc, key=None):
+        msg = "{doc} document with the key '{key}' already exists.".format(
+            doc=type(doc).__name__,
+            key=key or doc.doc_id,
+        )
+        super(KeyExists, self).__init__(msg)
+
+
+class OperationTimeout(CouchbasekitException):
+    """Raised when a couchbase operation doesn't complete within its
+    deadline, such as the ``timeout`` argument of
+    :meth:`couchbasekit.document.Document.save` or a model's ``__timeout__``.
+    See also :func:`couchbasekit.breaker.deadline`.
+    """
+    def __init__(self, bucket_name, operation):
+        msg = "'{operation}' operation on '{bucket}' bucket timed out.".format(
+            operation=operation,
+            bucket=bucket_name,
+        )
+        super(OperationTimeout, self).__init__(msg)
+
+
+class CircuitOpen(CouchbasekitException):
+    """Raised without calling couchbase at all while the circuit breaker of a
+    bucket is open, because of its repeated failures or timeouts. See
+    :class:`couchbasekit.breaker.CircuitBreaker`.
+    """
+    def __init__(self, bucket_name):
+        msg = "Circuit breaker of '{bucket}' bucket is open.".format(
+            bucket=bucket_name,
+        )
+        super(CircuitOpen, self).__init__(msg)
+
+
 class StructureError(CouchbasekitException):
     """Raised when things go wrong about your model class structure or instance
     values. For example, you pass an :class:`int` value to some field that
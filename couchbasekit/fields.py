@@ -11,9 +11,12 @@ couchbasekit.fields
 * :class:`couchbasekit.fields.ChoiceField`
 * :class:`couchbasekit.fields.EmailField`
 * :class:`couchbasekit.fields.PasswordField`
+* :class:`couchbasekit.fields.ChunkedListField`
 """
+import json
 import re
 from abc import ABCMeta
+from couchbasekit.connection import Connection, _memcached_error
 
 
 class CustomField(object):
@@ -119,12 +122,29 @@ class ChoiceField(CustomField):
 
 
 # stolen from django email validator:
-EMAIL_RE = re.compile(
+EMAIL_PATTERN = (
     r"(^[-!#$%&'*+/=?^_`{}|~0-9A-Z]+(\.[-!#$%&'*+/=?^_`{}|~0-9A-Z]+)*"  # dot-atom
     # quoted-string, see also http://tools.ietf.org/html/rfc2822#section-3.2.5
     r'|^"([\001-\010\013\014\016-\037!#-\[\]-\177]|\\[\001-\011\013\014\016-\177])*"'
     r')@((?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)$)'  # domain
-    r'|\[(25[0-5]|2[0-4]\d|[0-1]?\d?\d)(\.(25[0-5]|2[0-4]\d|[0-1]?\d?\d)){3}\]$', re.IGNORECASE)  # literal form, ipv4 address (SMTP 4.1.3)
+    r'|\[(25[0-5]|2[0-4]\d|[0-1]?\d?\d)(\.(25[0-5]|2[0-4]\d|[0-1]?\d?\d)){3}\]$'  # literal form, ipv4 address (SMTP 4.1.3)
+)
+
+
+class _LazyRegex(object):
+    # compiled on the first use, not at import time
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+        self._compiled = None
+
+    def __getattr__(self, name):
+        if self._compiled is None:
+            self._compiled = re.compile(self.pattern, self.flags)
+        return getattr(self._compiled, name)
+
+
+EMAIL_RE = _LazyRegex(EMAIL_PATTERN, re.IGNORECASE)
 
 
 class EmailField(CustomField):
@@ -196,4 +216,154 @@ class PasswordField(CustomField):
         :raises: :exc:`ImportError` if `py-bcrypt` was not found.
         """
         bcrypt = self.get_bcrypt()
-        return bcrypt.hashpw(raw_password, self.value)==self.value
\ No newline at end of file
+        return bcrypt.hashpw(raw_password, self.value)==self.value
+
+
+class ChunkedListField(CustomField):
+    """The custom field to be used for the long (and ever growing) lists,
+    which are kept in separate chunk documents of :attr:`CHUNK_SIZE` entries
+    each, rather than within the document itself. The document only keeps
+    the key of the list, so it stays small no matter how long the list is::
+
+        class BookList(ChunkedListField):
+            CHUNK_SIZE = 200
+            DOCUMENT = Book
+
+        class Author(Document):
+            # snip snip
+            structure = {
+                'books': BookList,
+            }
+
+    and to use it:
+
+    >>> author.books = BookList()
+    >>> author.save()
+    >>> author.books.append(book)
+    >>> for book in author.books:
+    ...     print book.title
+
+    Appending increments an atomic counter and appends to the tail chunk
+    only, right away, without saving the document. Iteration fetches the
+    chunks one by one, and the :attr:`DOCUMENT` instances with a single
+    multi-get per chunk.
+
+    .. note::
+       Chunks live in the bucket of the document they are accessed through,
+       and they are not deleted along with the document, see :meth:`clear`.
+
+    :param list_key: The key of an existing list, defaults to None that
+        creates a new list.
+    :type list_key: basestring
+    """
+    CHUNK_SIZE = 100
+    DOCUMENT = None
+    _bucket_name = None
+    _timeout = None
+
+    def __init__(self, list_key=None):
+        if list_key is None:
+            # uuid loads ctypes and libuuid, so not with couchbasekit
+            import uuid
+            list_key = 'list_%s' % uuid.uuid4().hex
+        self.value = list_key
+
+    def bind(self, doc):
+        """Binds the list to the document that it belongs to, which is done
+        by the document itself whenever the field is accessed.
+
+        :param doc: The document instance.
+        :type doc: :class:`couchbasekit.document.Document`
+        :returns: The list itself.
+        """
+        self._bucket_name = doc.__bucket_name__
+        self._timeout = doc.__timeout__
+        return self
+
+    def _call(self, operation, *args):
+        if self._bucket_name is None:
+            raise RuntimeError("%s is not bound to a document."
+                               % type(self).__name__)
+        return Connection.call(self._bucket_name, operation, args, self._timeout)
+
+    def _chunk_key(self, index):
+        return '%s_%d' % (self.value, index)
+
+    def append(self, item):
+        """Appends an entry to the end of the list.
+
+        :param item: JSON serializable value, or a :attr:`DOCUMENT`
+            instance to be stored as its document id.
+        :returns: The position of the entry, starting from 1.
+        :rtype: int
+        """
+        if self.DOCUMENT is not None and isinstance(item, self.DOCUMENT):
+            item = item.doc_id
+        elif isinstance(item, CustomField):
+            item = item.value
+        data = '%s,' % json.dumps(item)
+        position = int(self._call('incr', '%s_count' % self.value, 1, 1)[0])
+        chunk_key = self._chunk_key((position-1) // self.CHUNK_SIZE)
+        try:
+            self._call('append', chunk_key, data)
+        except _memcached_error() as why:
+            # raise if other than "not stored", i.e. a new chunk
+            if why.status!=5:
+                raise why
+            try:
+                self._call('add', chunk_key, 0, 0, data)
+            except _memcached_error() as why:
+                # raise if other than "key exists", created in the meantime
+                if why.status!=2:
+                    raise why
+                self._call('append', chunk_key, data)
+        return position
+
+    def __len__(self):
+        try:
+            return int(self._call('get', '%s_count' % self.value)[2])
+        except _memcached_error() as why:
+            # raise if other than "not found"
+            if why.status!=1:
+                raise why
+            return 0
+
+    def _read_chunk(self, index):
+        try:
+            data = self._call('get', self._chunk_key(index))[2]
+        except _memcached_error() as why:
+            # raise if other than "not found"
+            if why.status!=1:
+                raise why
+            return []
+        return json.loads('[%s]' % data.rstrip(','))
+
+    def __iter__(self):
+        chunks = (len(self) + self.CHUNK_SIZE - 1) // self.CHUNK_SIZE
+        for index in xrange(chunks):
+            items = self._read_chunk(index)
+            if self.DOCUMENT is None:
+                for item in items:
+                    yield item
+                continue
+            docs = self.DOCUMENT.get_multi(items)
+            for doc_id in items:
+                # deleted ones are skipped
+                if doc_id in docs:
+                    yield docs[doc_id]
+
+    def clear(self):
+        """Deletes all the chunks of the list, such as before deleting the
+        document that it belongs to.
+
+        :returns: None
+        """
+        chunks = (len(self) + self.CHUNK_SIZE - 1) // self.CHUNK_SIZE
+        for key in [self._chunk_key(i) for i in xrange(chunks)] + \
+                   ['%s_count' % self.value]:
+            try:
+                self._call('delete', key)
+            except _memcached_error() as why:
+                # raise if other than "not found"
+                if why.status!=1:
+                    raise why
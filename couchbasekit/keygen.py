@@ -0,0 +1,80 @@
+#! /usr/bin/env python
+"""
+couchbasekit.keygen
+~~~~~~~~~~~~~~~~~~~
+
+:website: http://github.com/kirpit/couchbasekit
+:copyright: Copyright 2013, Roy Enjoy <kirpit *at* gmail.com>, see AUTHORS.txt.
+:license: MIT, see LICENSE.txt for details.
+
+Document id generators for the model documents without a ``__key_field__``.
+None of them depends on the document content, so they are cheap to create
+even for the large documents.
+
+* :class:`couchbasekit.keygen.UUIDKey`
+* :class:`couchbasekit.keygen.TimeKey`
+* :class:`couchbasekit.keygen.CounterKey`
+"""
+import os
+import time
+
+
+class KeyGenerator(object):
+    """The base class of document id generators. Implement :meth:`__call__`
+    to create your own one and assign its instance to the model's
+    ``__key_generator__`` attribute::
+
+        class Book(Document):
+            __bucket_name__ = 'mybucket'
+            __key_generator__ = TimeKey()
+            doc_type = 'book'
+            structure = {
+                # snip snip
+            }
+    """
+    def __call__(self, doc):
+        """Returns a new document id for the given document.
+
+        :param doc: The document instance that is being saved.
+        :type doc: :class:`couchbasekit.document.Document`
+        :returns: New document id.
+        :rtype: str
+        """
+        raise NotImplementedError()
+
+
+class UUIDKey(KeyGenerator):
+    """Random UUID (version 4) document ids in hex format, such as
+    ``'4d0c8ab4e9f54e2c9b2f6e4d7c1a0b3e'``. This is the default one.
+    """
+    def __call__(self, doc):
+        # uuid loads ctypes and libuuid, so not with couchbasekit
+        import uuid
+        return uuid.uuid4().hex
+
+
+class TimeKey(KeyGenerator):
+    """Time-ordered document ids that are sorted by their creation time,
+    made of 12 hex digits of milliseconds since epoch and 8 random hex digits,
+    such as ``'013c1d2f6a9b5e0f31c2'``.
+    """
+    def __call__(self, doc):
+        millis = int(time.time() * 1000)
+        return '%012x%s' % (millis, os.urandom(4).encode('hex'))
+
+
+class CounterKey(KeyGenerator):
+    """Sequential document ids that are created by an atomic server-side
+    counter, such as ``'book_1'``, ``'book_2'`` and so on.
+
+    :param counter_key: The couchbase key of the counter, defaults to
+        ``'{doc_type}_counter'``.
+    :type counter_key: str
+    """
+    def __init__(self, counter_key=None):
+        self.counter_key = counter_key
+
+    def __call__(self, doc):
+        counter_key = self.counter_key or '%s_counter' % doc.doc_type
+        value = doc._call('incr', counter_key, 1, 1)[0]
+        return '%s_%d' % (doc.doc_type, int(value))
@@ -0,0 +1,147 @@
+#! /usr/bin/env python
+"""
+couchbasekit.migration
+~~~~~~~~~~~~~~~~~~~~~~
+
+:website: http://github.com/kirpit/couchbasekit
+:copyright: Copyright 2013, Roy Enjoy <kirpit *at* gmail.com>, see AUTHORS.txt.
+:license: MIT, see LICENSE.txt for details.
+"""
+import threading
+import time
+from couchbasekit.connection import Connection, _memcached_error
+
+
+class Migrator(object):
+    """Background migrator that upgrades the cold documents of a model to its
+    current ``__schema_version__``, so you don't have to wait for them to be
+    read and saved again by your application.
+
+    Documents are migrated lazily whenever they are fetched (see
+    :meth:`couchbasekit.document.Document.migration`), the migrator simply
+    goes through a view of the model and saves the ones that were upgraded
+    on-the-fly, at most ``rate`` documents per second. Documents are saved
+    with CAS, so a document that was written by your application in the
+    meantime is fetched (and migrated if still needed) again rather than
+    over-written::
+
+        migrator = Migrator(Author, 'all_authors', rate=50)
+        migrator.start()
+        # snip snip
+        migrator.stop()
+
+    :param model: The model document class to be migrated.
+    :type model: :class:`couchbasekit.document.Document` subclass
+    :param view_name: A map view of the model's design document that emits
+        all the documents to be checked.
+    :type view_name: str
+    :param batch_size: Number of view rows to be fetched per request,
+        defaults to 100.
+    :type batch_size: int
+    :param rate: Maximum number of documents to be checked per second,
+        defaults to 100.
+    :type rate: float
+    :param on_error: Callback to be called with ``(doc_id, exception)``
+        arguments when a document couldn't be migrated, defaults to None that
+        stops the migration.
+    :type on_error: callable
+    """
+    def __init__(self, model, view_name, batch_size=100, rate=100, on_error=None):
+        self.model = model
+        self.view_name = view_name
+        self.batch_size = batch_size
+        self.rate = rate
+        self.on_error = on_error
+        self.checked = 0
+        self.migrated = 0
+        self.failed = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run(self):
+        """Runs the migration in the calling thread until all the view rows
+        are checked or :meth:`stop` is called.
+
+        :returns: Number of documents migrated.
+        :rtype: int
+        """
+        interval = 1.0 / self.rate if self.rate else 0
+        next_at = time.time()
+        rows = self.model.iter_view(
+            self.view_name,
+            batch_size=self.batch_size,
+            params={'stale': 'ok'},
+        )
+        for row in rows:
+            if self._stop.is_set():
+                break
+            # throttle
+            wait = next_at - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            next_at = max(next_at, time.time() - interval) + interval
+            self.checked += 1
+            try:
+                if self._migrate(row['id']):
+                    self.migrated += 1
+            except self.model.DoesNotExist:
+                # deleted in the meantime
+                continue
+            except Exception as why:
+                self.failed += 1
+                if self.on_error is None:
+                    raise
+                self.on_error(row['id'], why)
+        return self.migrated
+
+    def _migrate(self, doc_id):
+        while True:
+            doc = self.model.from_doc_id(doc_id)
+            if doc.migrated_from is None:
+                return False
+            try:
+                doc._store(0, doc._prepare(), doc.cas_value)
+            except _memcached_error() as why:
+                # deleted in the meantime
+                if why.status==1:
+                    return False
+                # raise if other than CAS mismatch, changed in the meantime
+                if why.status!=2:
+                    raise why
+                continue
+            return True
+
+    def _run(self):
+        # application threads keep using the shared bucket handles
+        with Connection.private_buckets():
+            self.run()
+
+    def start(self):
+        """Starts the migration in a background thread.
+
+        :returns: None
+        """
+        if self._thread is not None and self._thread.is_alive():
+            raise RuntimeError("Migrator is running already.")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, wait=True):
+        """Stops the background migration after the current document.
+
+        :param wait: Wait for the thread to finish, defaults to True.
+        :type wait: bool
+        :returns: None
+        """
+        self._stop.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def is_alive(self):
+        """Returns True if the background migration is still running.
+
+        :rtype: bool
+        """
+        return self._thread is not None and self._thread.is_alive()
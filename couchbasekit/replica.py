@@ -0,0 +1,138 @@
+#! /usr/bin/env python
+"""
+couchbasekit.replica
+~~~~~~~~~~~~~~~~~~~~
+
+:website: http://github.com/kirpit/couchbasekit
+:copyright: Copyright 2013, Roy Enjoy <kirpit *at* gmail.com>, see AUTHORS.txt.
+:license: MIT, see LICENSE.txt for details.
+"""
+import Queue
+import threading
+from couchbasekit.connection import Connection, _memcached_error
+
+
+def _driver_replica_get(bucket, doc_id):
+    get_replica = getattr(bucket, 'get_replica', None) or \
+                  getattr(bucket, 'getReplica', None)
+    if get_replica is None:
+        raise RuntimeError("The couchbase driver doesn't support replica reads.")
+    return get_replica(doc_id)
+
+
+def _is_not_found(error):
+    return isinstance(error, _memcached_error()) and error.status==1
+
+
+class ReplicaRead(object):
+    """Opt-in replica reads for the latency sensitive models, which trade
+    consistency for a lower tail latency when a node is slow or rebalancing.
+    Assign an instance to your model's ``__replica_read__`` attribute::
+
+        class Profile(Document):
+            __bucket_name__ = 'mybucket'
+            __replica_read__ = ReplicaRead(hedge_delay=0.05)
+            doc_type = 'profile'
+            structure = {
+                # snip snip
+            }
+
+    Without a ``hedge_delay``, a replica is read only if the active node
+    fails with an error other than "not found". With a ``hedge_delay``, a
+    replica is also read if the active node hasn't answered within that many
+    seconds, and whichever answers first wins. Hedged reads run on long-lived
+    pooled bucket handles (see
+    :meth:`couchbasekit.connection.Connection.private_buckets`), so an
+    abandoned read never shares its socket. Documents that were read from a
+    replica have their ``from_replica`` attribute set to True, as they may be
+    stale.
+
+    .. warning::
+       A replica may lag behind the active node, so never read-modify-save
+       a document with ``from_replica`` set. Locked fetches always go to the
+       active node.
+
+    :param hedge_delay: Seconds to wait for the active node before reading a
+        replica as well, defaults to None (replica on failures only).
+    :type hedge_delay: float
+    :param replica_get: Callable with ``(bucket, doc_id)`` arguments that
+        reads a replica and returns ``(flags, cas, data)`` like
+        ``bucket.get()``, defaults to the driver's ``get_replica`` method.
+    :type replica_get: callable
+    """
+    def __init__(self, hedge_delay=None, replica_get=None):
+        self.hedge_delay = hedge_delay
+        self.replica_get = replica_get or _driver_replica_get
+
+    def get(self, bucket, doc_id):
+        """Reads a document either from the active node or from a replica.
+
+        :param bucket: The bucket of the document.
+        :type bucket: :class:`couchbase.client.Bucket`
+        :param doc_id: Couchbase document id.
+        :type doc_id: str
+        :returns: ``(flags, cas, data, from_replica)`` tuple.
+        :rtype: tuple
+        :raises: :exc:`couchbase.exception.MemcachedError` (with status 1 if
+            the active node tells the document doesn't exist) or the active
+            node's error if the replica couldn't be read either.
+        """
+        if self.hedge_delay is None:
+            try:
+                return bucket.get(doc_id) + (False,)
+            except Exception as why:
+                if _is_not_found(why):
+                    raise
+                try:
+                    return self.replica_get(bucket, doc_id) + (True,)
+                except Exception:
+                    raise why
+        return self._hedged_get(bucket, doc_id)
+
+    def _hedged_get(self, bucket, doc_id):
+        answers = Queue.Queue()
+
+        def _read(read, from_replica):
+            try:
+                # either read may be abandoned, so neither uses the shared
+                # handle, but a pooled one that is given back when it is done
+                with Connection.private_buckets():
+                    result = read(Connection.bucket(bucket.name))
+            except Exception as why:
+                answers.put((why, None, from_replica))
+            else:
+                answers.put((None, result, from_replica))
+
+        self._start(_read, lambda active: active.get(doc_id), False)
+        try:
+            first = answers.get(timeout=self.hedge_delay)
+        except Queue.Empty:
+            pending = 2
+        else:
+            # active node answered in time, or failed
+            if first[0] is None:
+                return first[1] + (False,)
+            if _is_not_found(first[0]):
+                raise first[0]
+            pending = 1
+        self._start(_read, lambda replica: self.replica_get(replica, doc_id),
+                    True)
+        error = None if pending==2 else first[0]
+        while pending:
+            why, result, from_replica = answers.get()
+            pending -= 1
+            if why is None:
+                return result + (from_replica,)
+            # active node is the authority of the misses
+            if not from_replica and _is_not_found(why):
+                raise why
+            if not from_replica or error is None:
+                error = why
+        raise error
+
+    @staticmethod
+    def _start(target, read, from_replica):
+        thread = threading.Thread(target=target, args=(read, from_replica))
+        # slow reads are abandoned, not waited for
+        thread.daemon = True
+        thread.start()
@@ -9,10 +9,83 @@ couchbasekit.schema
 """
 from abc import ABCMeta
 import datetime
-from dateutil.parser import parse
-from couchbasekit.fields import CustomField
+import re
+from couchbasekit.fields import CustomField, ChoiceField
 from couchbasekit.errors import StructureError
 
+# what we save (str() of the datetime by jsonpickle), i.e.
+# 2013-04-28 17:09:42.138000+00:00 but "T" separated ones are also accepted
+_ISO_DATETIME_RE = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?)?'
+    r'(Z|[+-]\d\d:\d\d)?$'
+)
+
+
+def _parse_datetime(value):
+    match = _ISO_DATETIME_RE.match(value)
+    if match is None:
+        # dateutil is imported on the first non-ISO datetime decode
+        from dateutil.parser import parse
+        return parse(value)
+    year, month, day, hour, minute, second, micro, offset = match.groups()
+    tzinfo = None
+    if offset is not None:
+        from dateutil.tz import tzutc, tzoffset
+        if offset in ('Z', '+00:00', '-00:00'):
+            tzinfo = tzutc()
+        else:
+            seconds = int(offset[1:3])*3600 + int(offset[4:6])*60
+            tzinfo = tzoffset(None, seconds if offset[0]=='+' else -seconds)
+    return datetime.datetime(
+        int(year), int(month), int(day), int(hour or 0), int(minute or 0),
+        int(second or 0), int((micro or '0').ljust(6, '0')), tzinfo,
+    )
+
+
+def _datetime_column(convert):
+    def decode(values):
+        # parsed once per distinct value
+        parsed = dict()
+        decoded = list()
+        for value in values:
+            if value not in parsed:
+                try:
+                    parsed[value] = convert(_parse_datetime(value))
+                except (ValueError, TypeError, AttributeError):
+                    # left to be decoded (and fail) on access
+                    parsed[value] = None
+            decoded.append(parsed[value])
+        return decoded
+    return decode
+
+
+def _choice_column(stype):
+    def decode(values):
+        # validated once per distinct choice
+        valid = dict()
+        decoded = list()
+        for value in values:
+            if value not in valid:
+                try:
+                    valid[value] = stype(value).value==value
+                except (ValueError, TypeError):
+                    valid[value] = False
+            if valid[value]:
+                choice = stype.__new__(stype)
+                choice.value = value
+                decoded.append(choice)
+            else:
+                decoded.append(None)
+        return decoded
+    return decode
+
+
+_COLUMN_DECODERS = {
+    datetime.datetime: _datetime_column(lambda value: value),
+    datetime.date: _datetime_column(lambda value: value.date()),
+    datetime.time: _datetime_column(lambda value: value.timetz()),
+}
+
 
 ALLOWED_TYPES = (
     bool,
@@ -49,27 +122,53 @@ class SchemaDocument(dict):
     structure = dict()
     default_values = dict()
     required_fields = tuple()
+    aliases = dict()
+    migrations = dict()
+    indexes = tuple()
+    aggregates = dict()
     is_new_record = True
+    __strict_validation__ = False
+    _decoded = None
+    _exposed = None
 
     def __init__(self, seq=None, **kwargs):
+        # check the class once, not per instance
+        if '_schema_checked' not in type(self).__dict__:
+            type(self)._check_schema()
+        seq = seq if isinstance(seq, dict) else {}
+        super(SchemaDocument, self).__init__(seq, **kwargs)
+
+    @classmethod
+    def _check_schema(cls):
         # check the required attributes
-        if not isinstance(self.__bucket_name__, str) or \
-           not isinstance(self.doc_type, str) or \
-           not isinstance(self.structure, dict):
-            raise self.StructureError(msg="Structure is not properly "
-                                          "set for %s." % type(self).__name__)
-        # check self.__key_field__ if correct
-        if self.__key_field__ and self.__key_field__ not in self.structure:
-            raise self.StructureError(
+        if not isinstance(cls.__bucket_name__, str) or \
+           not isinstance(cls.doc_type, str) or \
+           not isinstance(cls.structure, dict):
+            raise cls.StructureError(msg="Structure is not properly "
+                                         "set for %s." % cls.__name__)
+        # check cls.__key_field__ if correct
+        if cls.__key_field__ and cls.__key_field__ not in cls.structure:
+            raise cls.StructureError(
                 msg="Document key field must be within the "
-                    "structure, '%s' is given." % str(self.__key_field__)
+                    "structure, '%s' is given." % str(cls.__key_field__)
             )
-        # insert doc_type into the structure
-        self.structure.update(doc_type=unicode)
-        seq = seq if isinstance(seq, dict) else {}
-        super(SchemaDocument, self).__init__(seq, **kwargs)
+        # insert doc_type into (a copy of) the structure
+        if cls.structure.get('doc_type') is not unicode:
+            cls.structure = dict(cls.structure, doc_type=unicode)
+        cls._schema_checked = True
+
+    @classmethod
+    def _new(cls):
+        """Creates an empty instance for trusted data (such as the fetched
+        documents) without going through :meth:`__init__`.
+        """
+        if '_schema_checked' not in cls.__dict__:
+            cls._check_schema()
+        return dict.__new__(cls)
 
     def _decode_dict(self, structure, mapping):
+        # never touch the raw mapping
+        mapping = dict(mapping)
         for skey, svalue in structure.iteritems():
             map_keys = mapping.keys()
             # this is a type:type structure
@@ -98,15 +197,15 @@ class SchemaDocument(dict):
              not isinstance(value, datetime.datetime):
             # see: http://bugs.python.org/issue15873
             # see: http://bugs.python.org/issue6641
-            new_value = parse(value)
+            new_value = _parse_datetime(value)
         # fix date
         elif stype is datetime.date and not isinstance(value, datetime.date):
-            new_value = parse(value).date()
+            new_value = _parse_datetime(value).date()
         # fix time
         elif stype is datetime.time and not isinstance(value, datetime.time):
             # see: http://bugs.python.org/issue15873
             # see: http://bugs.python.org/issue6641
-            new_value = parse(value).timetz()
+            new_value = _parse_datetime(value).timetz()
         # fix CustomField
         elif isinstance(stype, type) and issubclass(stype, CustomField) and \
              not isinstance(value, stype):
@@ -115,8 +214,8 @@ class SchemaDocument(dict):
         elif isinstance(stype, type) and issubclass(stype, SchemaDocument) and \
              not isinstance(value, stype):
             if getattr(stype, '__key_field__') is not None:
-                doc_type, key = value.split('_', 1)
-                new_value = stype(key)
+                # strip "{doc_type}_" prefix
+                new_value = stype(value[len(stype.doc_type)+1:])
             else:
                 new_value = stype(value)
         # fix python list [instances]
@@ -129,27 +228,70 @@ class SchemaDocument(dict):
 
         return new_value
 
-    def __getitem__(self, item):
-        # usual error if key not found
-        if item not in self:
-            raise KeyError(item)
+    @classmethod
+    def _decode_columns(cls, docs):
+        # decode field by field, rather than document by document
+        for item, stype in cls.structure.iteritems():
+            if not isinstance(item, basestring):
+                continue
+            # nested structures are decoded on access
+            if not isinstance(stype, type):
+                continue
+            elif issubclass(stype, ChoiceField):
+                decode = _choice_column(stype)
+            elif stype in _COLUMN_DECODERS:
+                decode = _COLUMN_DECODERS[stype]
+            else:
+                continue
+            column = [(doc, doc.get(item)) for doc in docs]
+            column = [(doc, value) for doc, value in column
+                      if isinstance(value, basestring)]
+            if not column:
+                continue
+            decoded = decode([value for doc, value in column])
+            for (doc, value), new_value in zip(column, decoded):
+                if new_value is None:
+                    continue
+                if doc._decoded is None:
+                    doc._decoded = dict()
+                doc._decoded[item] = (value, new_value)
+
+    def _decode_field(self, item, expose=True):
         value = self.get(item)
         # TODO: schemaless should be converted as well
         # schemaless or out of structure
         if item not in self.structure:
-            return value
-        # make sure the accessed value respects our structure
-        try:
-            new_value = self._decode_item(self.structure[item], value)
-        except ValueError:
-            raise ValueError(
-                "Incorrect value for the field %s, '%s' was given." % (item, value)
-            )
-        # cache it
-        if new_value is not value:
-            self[item] = new_value
+            new_value = value
+        # decoded already, unless the raw value was replaced
+        elif self._decoded is not None and item in self._decoded and \
+             self._decoded[item][0] is value:
+            new_value = self._decoded[item][1]
+        else:
+            # make sure the accessed value respects our structure
+            try:
+                new_value = self._decode_item(self.structure[item], value)
+            except ValueError:
+                raise ValueError(
+                    "Incorrect value for the field %s, '%s' was given." % (item, value)
+                )
+            # cache it, separately from the raw value
+            if new_value is not value:
+                if self._decoded is None:
+                    self._decoded = dict()
+                self._decoded[item] = (value, new_value)
+        # it might be modified in-place from now on
+        if expose:
+            if self._exposed is None:
+                self._exposed = set()
+            self._exposed.add(item)
         return new_value
 
+    def __getitem__(self, item):
+        # usual error if key not found
+        if item not in self:
+            raise KeyError(item)
+        return self._decode_field(item)
+
     def load(self):
         """Helper function to pre-load all the raw document values into Python
         ones, custom types and/or other document relations as they are defined in
@@ -170,7 +312,9 @@ class SchemaDocument(dict):
 
         :returns: The Document instance itself on which was called from.
         """
-        [getattr(self, k) for k in self.iterkeys()]
+        for key in self.keys():
+            # decoded values replace the raw ones within the dict itself
+            self[key] = self._decode_field(key)
         return self
 
     def _validate(self, structure, mapping):
@@ -262,10 +406,23 @@ class SchemaDocument(dict):
             raise self.StructureError(skey, svalue, mapping[skey])
         return True
 
-    def validate(self):
+    def _changed_keys(self):
+        # None means everything, see Document
+        return None
+
+    def validate(self, strict=None):
         """Validates the document object with current values, always called
         within :meth:`couchbasekit.document.Document.save` method.
 
+        Fetched documents are validated incrementally, that is only the fields
+        which were set or accessed (so might be modified in-place) since they
+        were fetched are checked, besides the key and required fields. Set
+        your model's ``__strict_validation__`` attribute to True (or pass
+        ``strict=True``) to validate all the fields every time.
+
+        :param strict: Validate all the fields, defaults to None that is the
+            model's ``__strict_validation__`` attribute.
+        :type strict: bool
         :returns: Always True, or raises
             :exc:`couchbasekit.errors.StructureError` exception.
         :raises: :exc:`couchbasekit.errors.StructureError` if
@@ -278,8 +435,17 @@ class SchemaDocument(dict):
         # check the required fields first
         for required in self.required_fields:
             if (required not in self and required not in self.default_values) or \
-               (required in self and self[required] is None):
+               (required in self and self.get(required) is None):
                 raise self.StructureError(
                     msg = "Required field for '%s' is missing." % required
                 )
-        return self._validate(self.structure, self)
\ No newline at end of file
+        if strict is None:
+            strict = self.__strict_validation__
+        keys = None if strict else self._changed_keys()
+        # type pairs can't be checked partially
+        if keys is None or not all(isinstance(k, basestring) for k in self.structure):
+            decoded = dict((k, self._decode_field(k, expose=False)) for k in self)
+            return self._validate(self.structure, decoded)
+        structure = dict((k, self.structure[k]) for k in keys if k in self.structure)
+        decoded = dict((k, self._decode_field(k, expose=False)) for k in structure)
+        return self._validate(structure, decoded)
\ No newline at end of file
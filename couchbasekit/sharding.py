@@ -0,0 +1,193 @@
+#! /usr/bin/env python
+"""
+couchbasekit.sharding
+~~~~~~~~~~~~~~~~~~~~~
+
+:website: http://github.com/kirpit/couchbasekit
+:copyright: Copyright 2013, Roy Enjoy <kirpit *at* gmail.com>, see AUTHORS.txt.
+:license: MIT, see LICENSE.txt for details.
+
+Client-side sharding of model documents across multiple buckets, see the
+``__bucket_names__`` attribute of model documents.
+"""
+import bisect
+import hashlib
+from couchbasekit.connection import Connection, _memcached_error
+
+
+class ShardRouter(object):
+    """The base class of shard routers. Implement :meth:`__call__` to create
+    your own one and assign its instance to the model's ``__shard_router__``
+    attribute.
+    """
+    def __call__(self, doc_id, bucket_names):
+        """Returns the bucket that the given document belongs to.
+
+        :param doc_id: Couchbase document id.
+        :type doc_id: str
+        :param bucket_names: Shard buckets of the model.
+        :type bucket_names: tuple
+        :returns: One of the bucket names.
+        :rtype: str
+        """
+        raise NotImplementedError()
+
+
+class ConsistentHashRouter(ShardRouter):
+    """Routes documents by a consistent hash of their ids, so adding a bucket
+    to N others only moves about 1/(N+1) of the documents. This is the
+    default one.
+
+    :param points: Number of points per bucket on the hash ring, more points
+        spread the documents more evenly, defaults to 160.
+    :type points: int
+    """
+    def __init__(self, points=160):
+        self.points = points
+        self._rings = dict()
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(value).hexdigest()[:8], 16)
+
+    def _ring(self, bucket_names):
+        if bucket_names not in self._rings:
+            ring = sorted(
+                (self._hash('%s-%d' % (bucket_name, i)), bucket_name)
+                for bucket_name in bucket_names
+                for i in xrange(self.points)
+            )
+            self._rings[bucket_names] = ([h for h, _ in ring],
+                                         [name for _, name in ring])
+        return self._rings[bucket_names]
+
+    def __call__(self, doc_id, bucket_names):
+        if isinstance(doc_id, unicode):
+            doc_id = doc_id.encode('utf-8')
+        hashes, names = self._ring(bucket_names)
+        index = bisect.bisect(hashes, self._hash(doc_id))
+        return names[index % len(names)]
+
+
+def rebalance(model, old_bucket_names, view_name, batch_size=100,
+              dry_run=False, on_error=None):
+    """Moves the documents of a sharded model into their new buckets, after
+    its ``__bucket_names__`` were changed::
+
+        # Author.__bucket_names__ is ('authors1', 'authors2', 'authors3') now
+        rebalance(Author, ('authors1', 'authors2'), 'all_authors')
+
+    Each old bucket is read through the given map view of the model (so the
+    design document must exist in all the buckets) and the documents that
+    belong elsewhere are copied to their new bucket and deleted from the old
+    one with CAS. A document that was already written into its new bucket
+    (by the processes using the new shard set) is newer, so it is kept. A
+    document that changes while being moved is copied again, and the copy is
+    deleted if the source couldn't be, so a failed move is retried from
+    scratch by the next run.
+
+    .. warning::
+       Documents that are not moved yet look missing to the processes using
+       the new shard set, and their expiration is not moved along. Lookup
+       ``indexes``, ``aggregates`` and counters always live in the model's
+       ``__bucket_name__``, so they are not affected.
+
+    :param model: The sharded model document class.
+    :type model: :class:`couchbasekit.document.Document` subclass
+    :param old_bucket_names: Buckets that the documents were sharded to.
+    :type old_bucket_names: tuple
+    :param view_name: A map view of the model's design document that emits
+        all its documents.
+    :type view_name: str
+    :param batch_size: Number of view rows to be fetched per request,
+        defaults to 100.
+    :type batch_size: int
+    :param dry_run: Only count the documents to be moved, defaults to False.
+    :type dry_run: bool
+    :param on_error: Callback to be called with ``(doc_id, exception)``
+        arguments when a document couldn't be moved, defaults to None that
+        stops the rebalance.
+    :type on_error: callable
+    :returns: Number of documents moved (or to be moved on dry run).
+    :rtype: int
+    """
+    moved = 0
+    for source in old_bucket_names:
+        rows = model.iter_view(view_name, batch_size=batch_size,
+                               params={'stale': 'false'}, bucket_name=source)
+        for row in rows:
+            doc_id = row['id']
+            target = model._route(doc_id)
+            if target==source:
+                continue
+            if dry_run:
+                moved += 1
+                continue
+            try:
+                if _move(source, target, doc_id):
+                    moved += 1
+            except Exception as why:
+                if on_error is None:
+                    raise
+                on_error(doc_id, why)
+    return moved
+
+
+def _move(source, target, doc_id):
+    copy_cas = None
+    while True:
+        try:
+            flags, cas_value, data = Connection.call(source, 'get', (doc_id,))
+        except _memcached_error() as why:
+            # raise if other than "not found"
+            if why.status!=1:
+                raise why
+            if copy_cas is not None:
+                # deleted in the meantime, so is its copy
+                _delete(target, doc_id, copy_cas)
+            return False
+        if copy_cas is not None:
+            # changed after it was copied, the copy is stale
+            copy_cas = Connection.call(
+                target, 'set', (doc_id, 0, flags, data)
+            )[1]
+        else:
+            try:
+                copy_cas = Connection.call(
+                    target, 'add', (doc_id, 0, flags, data)
+                )[1]
+            except _memcached_error() as why:
+                # raise if other than "key exists", the target one is newer
+                if why.status!=2:
+                    raise why
+        try:
+            Connection.call(source, 'delete', (doc_id, cas_value))
+        except Exception as why:
+            memcached_error = isinstance(why, _memcached_error())
+            # changed after it was read, copy it again
+            if memcached_error and why.status==2:
+                continue
+            _abandon(target, doc_id, copy_cas)
+            # deleted in the meantime
+            if memcached_error and why.status==1:
+                return False
+            raise why
+        return True
+
+
+def _abandon(target, doc_id, copy_cas):
+    # never leave a copy behind for the next run to take as a newer one
+    if copy_cas is not None:
+        try:
+            _delete(target, doc_id, copy_cas)
+        except Exception:
+            pass
+
+
+def _delete(bucket_name, doc_id, cas_value):
+    try:
+        Connection.call(bucket_name, 'delete', (doc_id, cas_value))
+    except _memcached_error() as why:
+        # raise if other than "not found" or changed by somebody else
+        if why.status not in (1, 2):
+            raise why
@@ -7,10 +7,14 @@ couchbasekit.viewsync
 :copyright: Copyright 2013, Roy Enjoy <kirpit *at* gmail.com>, see AUTHORS.txt.
 :license: MIT, see LICENSE.txt for details.
 """
+import hashlib
+import json
 import os
 import shutil
-from couchbase.exception import BucketUnavailableException
+import time
+from collections import namedtuple
 from couchbasekit import Connection, Document
+from couchbasekit.connection import _memcached_error
 
 
 def register_view(design_doc, full_set=True):
@@ -39,15 +43,34 @@ def register_view(design_doc, full_set=True):
     return _injector
 
 
+SyncResult = namedtuple('SyncResult', 'bucket design_doc status error')
+
+
+def _is_missing(error):
+    # the server answers {"error": "not_found", ...} for a missing design doc
+    if isinstance(error, KeyError) or 'not_found' in str(error):
+        return True
+    return isinstance(error, _memcached_error()) and error.status==1
+
+
+def _is_timeout(error):
+    # either the socket or the server ({"error": "timeout", ...}) timed out
+    import socket
+    return isinstance(error, socket.timeout) or 'timeout' in str(error).lower()
+
+
 class ViewSync(object):
     """This is an experimental helper to download, upload and synchronize your
     couchbase views (both map and reduce JavaScript functions) in an organized
     way.
 
-    Unfortunately, it's quite impossible to synchronize these views since
-    couchbase doesn't provide any information about when a specific view was
-    created and modified. So we can't know if previously downloaded .js file or
-    the current one at couchbase server should be replaced..
+    Unfortunately, it's quite impossible to synchronize these views in both
+    ways since couchbase doesn't provide any information about when a specific
+    view was created and modified. So we can't know if previously downloaded
+    .js file or the current one at couchbase server should be replaced.. That's
+    why :meth:`sync` only uploads the local design documents whose content
+    differs from the server-side ones, in order not to rebuild the unchanged
+    view indexes.
 
     This class also works in a singleton pattern so all its methods are
     ``@classmethod`` that you don't need to create an instance at all.
@@ -58,8 +81,16 @@ class ViewSync(object):
     also become your view backups::
 
         ViewSync.VIEW_PATH = '/path/to/your/js/view/backups'
+
+    Design documents are downloaded and uploaded concurrently by at most
+    :attr:`MAX_WORKERS` threads, and the methods never change the current
+    working directory, so they are safe to be called within threaded
+    applications. They all return a list of
+    ``SyncResult(bucket, design_doc, status, error)`` named tuples, one per
+    design document.
     """
     VIEWS_PATH = None
+    MAX_WORKERS = 4
     _documents = set()
 
     @classmethod
@@ -70,6 +101,20 @@ class ViewSync(object):
             raise RuntimeError(
                 "Directory must created first; '%s'" % cls.VIEWS_PATH
             )
+        return os.path.abspath(cls.VIEWS_PATH)
+
+    @classmethod
+    def _map(cls, func, items):
+        if not items:
+            return []
+        # imported on the first sync, not with couchbasekit
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(cls.MAX_WORKERS, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
 
     @classmethod
     def download(cls):
@@ -77,74 +122,94 @@ class ViewSync(object):
         documents into the defined :attr:`VIEW_PATHS` directory.
 
         This method **removes** previous views directory if exist.
+
+        :returns: List of :class:`SyncResult` with ``'downloaded'`` or
+            ``'failed'`` status.
+        :rtype: list
         """
-        cls._check_folder()
-        os.chdir(cls.VIEWS_PATH)
-        # iterate documents
+        from couchbase.exception import BucketUnavailableException
+        views_path = cls._check_folder()
+        # open the buckets within this thread, Connection is not thread-safe
+        # one per design document, models sharing it would write the same
+        # directory concurrently
+        documents = dict()
+        failed = dict()
         for doc in cls._documents:
-            design_doc = doc().view()
-            if design_doc is None:
+            bucket_name = doc.__bucket_name__
+            if bucket_name in failed or \
+               (bucket_name, doc.__view_name__) in documents:
+                continue
+            try:
+                Connection.bucket(bucket_name)
+            except BucketUnavailableException as why:
+                failed[bucket_name] = SyncResult(bucket_name, None,
+                                                 'failed', why)
                 continue
-            bucket_name = design_doc.bucket.name
-            # iterate viewtypes (i.e. spatial and views)
-            for view_type, views in design_doc.ddoc.iteritems():
-                save_dir = '%s/%s/%s' % (bucket_name, design_doc.name, view_type)
-                try:
-                    # remove and recreate the dir
-                    shutil.rmtree(save_dir, ignore_errors=True)
-                    os.makedirs(save_dir)
-                except OSError:
-                    pass
-                for name, view in views.iteritems():
-                    if isinstance(view, unicode) and view_type=='spatial':
-                        spatial_file = '%s/%s.spatial.js' % (save_dir, name)
-                        with open(spatial_file, 'w') as f:
-                            f.write(view)
-                        print 'Downloaded: %s' % spatial_file
-                    if isinstance(view, dict) and 'map' in view:
-                        map_file = '%s/%s.map.js' % (save_dir, name)
-                        with open(map_file, 'w') as f:
-                            f.write(view['map'])
-                        print 'Downloaded: %s' % map_file
-                    if isinstance(view, dict) and 'reduce' in view:
-                        reduce_file = '%s/%s.reduce.js' % (save_dir, name)
-                        with open(reduce_file, 'w') as f:
-                            f.write(view['reduce'])
-                        print 'Downloaded: %s' % reduce_file
-        pass
+            documents[(bucket_name, doc.__view_name__)] = doc
 
-    @classmethod
-    def upload(cls):
-        """Uploads all the local views from :attr:`VIEW_PATHS` directory
-        to CouchBase server
+        def _download(doc):
+            try:
+                design_doc = doc().view()
+                if design_doc is None:
+                    return None
+                cls._write_design_doc(views_path, design_doc)
+            except Exception as why:
+                return SyncResult(doc.__bucket_name__, doc.__view_name__,
+                                  'failed', why)
+            return SyncResult(design_doc.bucket.name, design_doc.name,
+                              'downloaded', None)
 
-        This method **over-writes** all the server-side views with the same
-        named ones coming from :attr:`VIEW_PATHS` folder.
-        """
-        cls._check_folder()
-        os.chdir(cls.VIEWS_PATH)
-        buckets = dict()
+        results = failed.values() + cls._map(_download, documents.values())
+        return [result for result in results if result is not None]
+
+    @staticmethod
+    def _write_design_doc(views_path, design_doc):
+        bucket_name = design_doc.bucket.name
+        # iterate viewtypes (i.e. spatial and views)
+        for view_type, views in design_doc.ddoc.iteritems():
+            save_dir = os.path.join(views_path, bucket_name,
+                                    design_doc.name, view_type)
+            try:
+                # remove and recreate the dir
+                shutil.rmtree(save_dir, ignore_errors=True)
+                os.makedirs(save_dir)
+            except OSError:
+                pass
+            for name, view in views.iteritems():
+                if isinstance(view, unicode) and view_type=='spatial':
+                    spatial_file = os.path.join(save_dir, '%s.spatial.js' % name)
+                    with open(spatial_file, 'w') as f:
+                        f.write(view)
+                if isinstance(view, dict) and 'map' in view:
+                    map_file = os.path.join(save_dir, '%s.map.js' % name)
+                    with open(map_file, 'w') as f:
+                        f.write(view['map'])
+                if isinstance(view, dict) and 'reduce' in view:
+                    reduce_file = os.path.join(save_dir, '%s.reduce.js' % name)
+                    with open(reduce_file, 'w') as f:
+                        f.write(view['reduce'])
+
+    @classmethod
+    def _read_design_docs(cls, views_path):
+        from couchbase.exception import BucketUnavailableException
+        design_docs = list()
+        failed = list()
         # iterate local folders
-        for bucket_name in os.listdir(cls.VIEWS_PATH):
-            if not os.path.isdir(bucket_name):
+        for bucket_name in os.listdir(views_path):
+            bucket_path = os.path.join(views_path, bucket_name)
+            if not os.path.isdir(bucket_path):
                 continue
             # get bucket object
-            if bucket_name not in buckets:
-                try:
-                    bucket = Connection.bucket(bucket_name)
-                except BucketUnavailableException as why:
-                    print "[WARNING] %s" % str(why)
-                    continue
-                else:
-                    buckets[bucket_name] = bucket
-            else:
-                bucket = buckets[bucket_name]
+            try:
+                bucket = Connection.bucket(bucket_name)
+            except BucketUnavailableException as why:
+                failed.append(SyncResult(bucket_name, None, 'failed', why))
+                continue
             # go through design docs
-            for ddoc_name in os.listdir(bucket_name):
-                views_path = '%s/%s/views' % (bucket_name, ddoc_name)
-                spatial_path = '%s/%s/spatial' % (bucket_name, ddoc_name)
-                if not (os.path.exists(views_path) and os.path.isdir(views_path)) and \
-                   not (os.path.exists(spatial_path) and os.path.isdir(spatial_path)):
+            for ddoc_name in os.listdir(bucket_path):
+                views_dir = os.path.join(bucket_path, ddoc_name, 'views')
+                spatial_dir = os.path.join(bucket_path, ddoc_name, 'spatial')
+                if not os.path.isdir(views_dir) and not os.path.isdir(spatial_dir):
                     continue
                 # initialize design doc
                 new_ddoc = {
@@ -152,30 +217,187 @@ class ViewSync(object):
                     'spatial': {},
                 }
                 # map and reduces
-                if os.path.exists(views_path) and os.path.isdir(views_path):
-                    for filename in os.listdir(views_path):
-                        if not os.path.isfile('%s/%s' % (views_path, filename)) or \
+                if os.path.isdir(views_dir):
+                    for filename in os.listdir(views_dir):
+                        filepath = os.path.join(views_dir, filename)
+                        if not os.path.isfile(filepath) or \
                            not filename.endswith(('.map.js', '.reduce.js')):
                             continue
                         view_name, view_type, js = filename.rsplit('.', 2)
                         if view_name not in new_ddoc['views']:
                             new_ddoc['views'][view_name] = {}
-                        with open('%s/%s' % (views_path, filename), 'r') as f:
+                        with open(filepath, 'r') as f:
                             new_ddoc['views'][view_name][view_type] = f.read()
                 # spatial views
-                if os.path.exists(spatial_path) and os.path.isdir(spatial_path):
-                    for filename in os.listdir(spatial_path):
-                        if not os.path.isfile('%s/%s' % (spatial_path, filename)) or \
+                if os.path.isdir(spatial_dir):
+                    for filename in os.listdir(spatial_dir):
+                        filepath = os.path.join(spatial_dir, filename)
+                        if not os.path.isfile(filepath) or \
                            not filename.endswith('.spatial.js'):
                             continue
                         view_name = filename.rsplit('.', 2)[0]
-                        with open('%s/%s' % (spatial_path, filename), 'r') as f:
+                        with open(filepath, 'r') as f:
                             new_ddoc['spatial'][view_name] = f.read()
+                design_docs.append((bucket, ddoc_name, new_ddoc))
+        return design_docs, failed
+
+    @staticmethod
+    def content_hash(ddoc):
+        """Returns the content hash of a design document, which only depends
+        on its map, reduce and spatial functions.
+
+        :param ddoc: Design document definition with ``'views'`` and/or
+            ``'spatial'`` keys.
+        :type ddoc: dict
+        :returns: SHA-1 hex digest.
+        :rtype: str
+        """
+        content = dict()
+        for view_type in ('views', 'spatial'):
+            if ddoc.get(view_type):
+                content[view_type] = ddoc[view_type]
+        # str and unicode functions end up the same with ascii escaping
+        return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+    @classmethod
+    def _server_hash(cls, bucket, ddoc_name):
+        try:
+            design_doc = bucket['_design/%s' % ddoc_name]
+        except Exception as why:
+            # not created yet, raise the others (such as network or auth
+            # errors) not to re-push an unchanged design doc
+            if _is_missing(why):
+                return None
+            raise why
+        return cls.content_hash(design_doc.ddoc)
+
+    @classmethod
+    def _push(cls, design_docs, force=False, dry_run=False):
+        def _push_one(item):
+            bucket, ddoc_name, new_ddoc = item
+            try:
+                server_hash = cls._server_hash(bucket, ddoc_name)
+                if server_hash is None:
+                    status = 'new'
+                elif server_hash!=cls.content_hash(new_ddoc):
+                    status = 'changed'
+                else:
+                    status = 'unchanged'
+                if dry_run or (status=='unchanged' and not force):
+                    return SyncResult(bucket.name, ddoc_name, status, None)
                 bucket['_design/%s' % ddoc_name] = new_ddoc
-                print 'Uploaded design document: %s' % ddoc_name
-        pass
+            except Exception as why:
+                return SyncResult(bucket.name, ddoc_name, 'failed', why)
+            return SyncResult(bucket.name, ddoc_name, 'uploaded', None)
+        return cls._map(_push_one, design_docs)
+
+    @classmethod
+    def diff(cls):
+        """Compares the local views in :attr:`VIEW_PATHS` directory with the
+        server-side ones by their content hashes, without uploading anything
+        (a.k.a. dry-run).
+
+        :returns: List of :class:`SyncResult` with ``'new'``, ``'changed'``,
+            ``'unchanged'`` or ``'failed'`` status.
+        :rtype: list
+        """
+        design_docs, failed = cls._read_design_docs(cls._check_folder())
+        return failed + cls._push(design_docs, dry_run=True)
 
     @classmethod
-    def sync(cls):
-        """Not implemented yet."""
-        raise NotImplementedError()
+    def upload(cls, force=False):
+        """Uploads the local views from :attr:`VIEW_PATHS` directory
+        to CouchBase server.
+
+        Each upload makes couchbase rebuild the view indexes of that design
+        document, so only the design documents whose content hash differs
+        from the server-side one are uploaded, unless ``force`` is True.
+
+        This method **over-writes** the changed server-side views with the
+        same named ones coming from :attr:`VIEW_PATHS` folder.
+
+        :param force: Upload all the design documents, defaults to False.
+        :type force: bool
+        :returns: List of :class:`SyncResult` with ``'uploaded'``,
+            ``'unchanged'`` or ``'failed'`` status.
+        :rtype: list
+        """
+        design_docs, failed = cls._read_design_docs(cls._check_folder())
+        return failed + cls._push(design_docs, force=force)
+
+    @classmethod
+    def warmup(cls, results, timeout=600, interval=5, progress=None):
+        """Builds the view indexes of the uploaded design documents right away,
+        instead of letting the first real query wait for them. Every view is
+        queried with ``stale=false`` and ``limit=0`` until it answers or the
+        ``timeout`` is reached, so your deploy scripts can gate the traffic on
+        it::
+
+            results = ViewSync.warmup(ViewSync.upload())
+            if any(r.status!='ready' for r in results):
+                sys.exit('Views are not ready yet.')
+
+        :param results: Results of :meth:`upload`, only the ``'uploaded'``
+            ones are warmed up.
+        :type results: list
+        :param timeout: Maximum seconds to wait for each design document,
+            defaults to 600.
+        :type timeout: float
+        :param interval: Seconds between the retries of a timed out query,
+            other errors fail the design document right away, defaults to 5.
+        :type interval: float
+        :param progress: Callback to be called with ``(bucket_name,
+            design_doc_name, view_name, status)`` arguments as views are
+            ``'building'`` and ``'ready'``, defaults to None.
+        :type progress: callable
+        :returns: List of :class:`SyncResult` with ``'ready'``,
+            ``'timeout'`` or ``'failed'`` status.
+        :rtype: list
+        """
+        def _report(*args):
+            if progress is not None:
+                progress(*args)
+
+        def _warmup(result):
+            deadline = time.time() + timeout
+            try:
+                bucket = Connection.bucket(result.bucket)
+                design_doc = bucket['_design/%s' % result.design_doc]
+                for view in design_doc.views():
+                    _report(result.bucket, result.design_doc, view.name, 'building')
+                    while True:
+                        try:
+                            view.results({'stale': 'false', 'limit': 0})
+                        except Exception as why:
+                            # only the timed out queries are retried
+                            if not _is_timeout(why):
+                                raise why
+                            if time.time() + interval > deadline:
+                                return SyncResult(result.bucket, result.design_doc,
+                                                  'timeout', why)
+                            time.sleep(interval)
+                        else:
+                            break
+                    _report(result.bucket, result.design_doc, view.name, 'ready')
+            except Exception as why:
+                return SyncResult(result.bucket, result.design_doc, 'failed', why)
+            return SyncResult(result.bucket, result.design_doc, 'ready', None)
+
+        uploaded = [r for r in results if r.status=='uploaded']
+        # open the buckets within this thread, Connection is not thread-safe
+        for result in uploaded:
+            Connection.bucket(result.bucket)
+        return cls._map(_warmup, uploaded)
+
+    @classmethod
+    def sync(cls, dry_run=False):
+        """Uploads only the changed design documents, see :meth:`upload`.
+
+        :param dry_run: Only report the differences, see :meth:`diff`.
+        :type dry_run: bool
+        :returns: See :meth:`diff` and :meth:`upload`.
+        :rtype: list
+        """
+        if dry_run:
+            return cls.diff()
+        return cls.upload()
@@ -0,0 +1,159 @@
+#! /usr/bin/env python
+"""
+couchbasekit.writebehind
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+:website: http://github.com/kirpit/couchbasekit
+:copyright: Copyright 2013, Roy Enjoy <kirpit *at* gmail.com>, see AUTHORS.txt.
+:license: MIT, see LICENSE.txt for details.
+"""
+import threading
+from collections import OrderedDict
+from couchbasekit.connection import Connection
+from couchbasekit.errors import KeyExists
+
+
+class WriteBehind(object):
+    """Write-behind buffer that queues document saves and writes them to
+    couchbase in batches from a background thread.
+
+    Repeated saves of the same document are coalesced, so only its latest
+    state is written when the buffer is flushed. Simply attach a buffer to
+    your model document (or share one between several models) and
+    :meth:`couchbasekit.document.Document.save` will queue the document
+    instead of writing it immediately::
+
+        progress_buffer = WriteBehind(max_size=500, interval=0.5)
+
+        class Progress(Document):
+            __bucket_name__ = 'mybucket'
+            __write_behind__ = progress_buffer
+            doc_type = 'progress'
+            structure = {
+                # snip snip
+            }
+
+    .. note::
+       Queued documents are kept in memory only, so don't forget to call
+       :meth:`close` (or at least :meth:`flush`) before your process exits.
+
+    :param max_size: Number of pending documents that triggers a flush,
+        defaults to 100.
+    :type max_size: int
+    :param interval: Maximum seconds that a save waits in the buffer,
+        defaults to 0.5.
+    :type interval: float
+    :param on_error: Callback to be called with ``(document, exception)``
+        arguments when a queued document couldn't be written, defaults to None.
+    :type on_error: callable
+    """
+    def __init__(self, max_size=100, interval=0.5, on_error=None):
+        self.max_size = max_size
+        self.interval = interval
+        self.on_error = on_error
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, doc, expiration, json_data):
+        """Queues a document to be written, replacing any pending write of
+        the same document.
+
+        :param doc: The document instance to be written.
+        :type doc: :class:`couchbasekit.document.Document`
+        :param expiration: Expiration in seconds for the document.
+        :type expiration: int
+        :param json_data: Encoded document data.
+        :type json_data: str
+        :returns: None
+        :raises: :exc:`RuntimeError` if the buffer was closed already.
+        """
+        key = (doc.__bucket_name__, doc.doc_id)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Write-behind buffer is closed already.")
+            # latest state wins, and moves to the end of the queue
+            self._pending.pop(key, None)
+            self._pending[key] = (doc, expiration, json_data)
+            if len(self._pending) >= self.max_size:
+                self._condition.notify()
+
+    def flush(self):
+        """Writes all the pending documents to couchbase, in the calling
+        thread.
+
+        If there is no :attr:`on_error` callback, failed documents are queued
+        again (unless saved once more in the meantime) and the last error is
+        raised after the whole batch was tried. Documents that failed with
+        :exc:`couchbasekit.errors.KeyExists` are never queued again, as
+        retrying them can't succeed.
+
+        :returns: Number of documents written successfully.
+        :rtype: int
+        """
+        with self._flush_lock:
+            with self._condition:
+                pending, self._pending = self._pending, OrderedDict()
+            written = 0
+            error = None
+            for key, item in pending.iteritems():
+                doc, expiration, json_data = item
+                try:
+                    doc._store(expiration, json_data)
+                except Exception as why:
+                    if self.on_error is not None:
+                        self.on_error(doc, why)
+                        continue
+                    error = why
+                    # the generated id was taken and cleared, or a unique
+                    # value belongs to another document
+                    if isinstance(why, KeyExists):
+                        continue
+                    with self._condition:
+                        self._pending.setdefault(key, item)
+                else:
+                    written += 1
+            if error is not None:
+                raise error
+            return written
+
+    def close(self):
+        """Stops the background thread and flushes the pending documents.
+
+        :returns: Number of documents written by the final flush.
+        :rtype: int
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        return self.flush()
+
+    def _run(self):
+        # application threads keep using the shared bucket handles
+        with Connection.private_buckets():
+            self._flush_loop()
+
+    def _flush_loop(self):
+        failed = False
+        while True:
+            with self._condition:
+                if not self._closed and \
+                   (failed or len(self._pending) < self.max_size):
+                    self._condition.wait(self.interval)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                # failed ones are queued again, retry after a while
+                failed = True
+            else:
+                failed = False
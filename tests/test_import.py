@@ -0,0 +1,43 @@
+#! /usr/bin/env python
+"""
+tests.test_import
+~~~~~~~~~~~~~~~~~
+
+:website: http://github.com/kirpit/couchbasekit
+:copyright: Copyright 2013, Roy Enjoy <kirpit *at* gmail.com>, see AUTHORS.txt.
+:license: MIT, see LICENSE.txt for details.
+
+Keeps ``import couchbasekit`` cheap, run with::
+
+    python -m unittest discover tests
+"""
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# loaded on their first use only
+HEAVY_MODULES = (
+    'couchbase', 'jsonpickle', 'dateutil', 'uuid', 'ctypes',
+    'multiprocessing', 'urllib', 'socket', 'ssl',
+)
+
+
+def _imported_modules(statement):
+    # in a fresh interpreter, nothing is imported already
+    code = 'import sys; %s; print("\\n".join(sys.modules))' % statement
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    return set(output.split())
+
+
+class ImportTest(unittest.TestCase):
+    def test_heavy_modules_are_lazy(self):
+        modules = _imported_modules('import couchbasekit')
+        loaded = [name for name in HEAVY_MODULES if name in modules]
+        self.assertEqual(loaded, [])
+
+
+if __name__ == '__main__':
+    unittest.main()